@@ -1,86 +1,240 @@
 import ast
+import hashlib
 import json
 import os
 import re
+import tempfile
+import threading
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Literal
-import numpy as np
+import warnings
+from importlib.machinery import SourceFileLoader
 import csv
 
-from conftest import load_source
-
 AUTHOR_ID_TOKEN = "# AUTHOR_ID:"
 GRADER_TOKEN = "# GRADER:"
 
+# Grader messages (e.g. the assertion message of a huge list comparison) are cut to this size
+MAX_MESSAGE_LINES = 20
+MAX_MESSAGE_LINE_LENGTH = 200
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# The lock files of `locked_file`, out of the submission folders
+LOCK_DIR = os.path.join(tempfile.gettempdir(), "grader_locks")
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+
+@contextmanager
+def locked_file(fn: str):
+    """
+    Holds an exclusive lock on `fn` for the duration of the context, across threads and processes, so that
+    concurrent read-modify-write cycles of the same file do not lose updates. The lock is taken on a file in
+    `LOCK_DIR` named after the absolute path of `fn`, since `atomic_write` replaces `fn` itself. The lock files
+    stay there (removing them would race with the processes waiting on them), they are empty.
+    """
+    path_hash = hashlib.sha1(os.path.abspath(fn).encode("utf-8")).hexdigest()
+    lock_fn = os.path.join(LOCK_DIR, f"{path_hash}.lock")
+    if fcntl is None:
+        # no file locks on this platform, at least serialize the threads of this process
+        with _thread_locks_lock:
+            lock = _thread_locks.setdefault(lock_fn, threading.Lock())
+        with lock:
+            yield
+        return
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    with open(lock_fn, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def atomic_write(fn: str, content: str, errors: str = "strict"):
+    """
+    Replaces the content of `fn`: the content is written and fsync-ed to a temporary file in the same directory,
+    which is then renamed over `fn`, so that `fn` is never left truncated or half written, even if the process
+    is killed. `errors` is the error handler of the utf-8 encoding, as in `open`.
+    """
+    directory = os.path.dirname(os.path.abspath(fn))
+    fd, tmp_fn = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", errors=errors, newline="") as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        if os.path.exists(fn):
+            # mkstemp creates the file readable by the owner only, keep the original permissions
+            os.chmod(tmp_fn, os.stat(fn).st_mode & 0o7777)
+        os.replace(tmp_fn, fn)
+    except BaseException:
+        os.remove(tmp_fn)
+        raise
+    if hasattr(os, "O_DIRECTORY"):
+        # make the rename itself durable
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def summarize_message(message) -> str:
+    """
+    Returns `message` cut to MAX_MESSAGE_LINES lines of at most MAX_MESSAGE_LINE_LENGTH characters, with a
+    marker of what was cut.
+    """
+    lines = str(message).split("\n", MAX_MESSAGE_LINES)
+    if len(lines) > MAX_MESSAGE_LINES:
+        n_more = lines.pop().count("\n") + 2
+        lines[-1] = f"... ({n_more} more lines)"
+    return "\n".join(
+        (
+            line
+            if len(line) <= MAX_MESSAGE_LINE_LENGTH
+            else line[:MAX_MESSAGE_LINE_LENGTH]
+            + f"... ({len(line) - MAX_MESSAGE_LINE_LENGTH} more characters)"
+        )
+        for line in lines
+    )
+
+
+def load_source(what, path):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        solution = SourceFileLoader(what, path).load_module()
+
+    return solution
+
 
 def _update_assignment_function(
     solution, function, message, score_fixture, points_to_reduce
 ):
-    solution_file = solution.__file__
+    points = annotate_function(
+        solution.__file__, function.__name__, message, points_to_reduce
+    )
+    if points is None:
+        # e.g. a method inherited from a base class, as in `deduct_points`
+        points = annotate_file(solution.__file__, message, points_to_reduce)
+    score_fixture["total"] += points
 
-    with open(solution_file, "r") as file:
-        content = file.read()
 
-    tree = ast.parse(content)
+def annotate_function(solution_file, function_name, message, points_to_reduce):
+    """
+    Writes a grader note and the deducted points into the first function called `function_name` in
+    `solution_file`. Returns the (negative) points, or None if there is no such function.
+    """
+    message = summarize_message(message)
+    with locked_file(solution_file):
+        with open(solution_file, "r") as file:
+            content = file.read()
 
-    def find_function(node, target):
-        if isinstance(node, ast.FunctionDef) and node.name == target.__name__:
-            return node
-        for child in ast.iter_child_nodes(node):
-            result = find_function(child, target)
-            if result is not None:
-                return result
+        tree = ast.parse(content)
 
-    func_node = find_function(tree, function)
+        def find_function(node, target):
+            if isinstance(node, ast.FunctionDef) and node.name == target:
+                return node
+            for child in ast.iter_child_nodes(node):
+                result = find_function(child, target)
+                if result is not None:
+                    return result
 
-    if func_node:
-        docstring = ast.get_docstring(func_node)
-        if docstring:
-            docstring_lines = len(docstring.splitlines())
-            insertion_point = func_node.body[0].lineno + docstring_lines + 1
-        else:
-            insertion_point = func_node.body[0].lineno + 1
+        func_node = find_function(tree, function_name)
 
-        lines = content.splitlines()
-        func_indent = len(re.match(r"\s*", lines[func_node.lineno - 1]).group(0))
-        indent_str = " " * func_indent
-        err_lines = [
-            indent_str + GRADER_TOKEN + line for line in str(message).split("\n")
-        ]
-        points_to_reduce = np.round(points_to_reduce, 1)
-        points = -points_to_reduce
+        if func_node:
+            docstring = ast.get_docstring(func_node)
+            if docstring:
+                docstring_lines = len(docstring.splitlines())
+                insertion_point = func_node.body[0].lineno + docstring_lines + 1
+            else:
+                insertion_point = func_node.body[0].lineno + 1
+
+            lines = content.splitlines()
+            func_indent = len(re.match(r"\s*", lines[func_node.lineno - 1]).group(0))
+            indent_str = " " * func_indent
+            err_lines = [
+                indent_str + GRADER_TOKEN + line for line in str(message).split("\n")
+            ]
+            points_to_reduce = round(points_to_reduce, 1)
+            points = -points_to_reduce
 
-        err_lines.append(indent_str + f"{GRADER_TOKEN} {points} points")
-        score_fixture["total"] += points
+            err_lines.append(indent_str + f"{GRADER_TOKEN} {points} points")
 
-        for line in reversed(err_lines):
-            lines.insert(insertion_point + 1, line)
+            for line in reversed(err_lines):
+                lines.insert(insertion_point + 1, line)
 
-        with open(solution_file, "w") as file:
-            file.write("\n".join(lines))
+            atomic_write(solution_file, "\n".join(lines))
+            return points
 
 
 def _update_assignment_file(solution, message, score_fixture, points_to_reduce):
-    solution_file = solution.__file__
+    points = annotate_file(solution.__file__, message, points_to_reduce)
+    score_fixture["total"] += points
 
-    with open(solution_file, "r") as file:
-        content = file.read()
 
-    lines = content.splitlines()
-    err_lines = [f"{GRADER_TOKEN} {line}" for line in str(message).split("\n")]
-    points_to_reduce = np.round(points_to_reduce, 1)
-    points = -points_to_reduce
-    err_lines.append(f"{GRADER_TOKEN} {points} points")
-    score_fixture["total"] += points
-    lines.extend(err_lines)
+def annotate_file(solution_file, message, points_to_reduce):
+    """
+    Appends a grader note and the deducted points to the end of `solution_file`. Returns the (negative) points.
+    """
+    message = summarize_message(message)
+    with locked_file(solution_file):
+        with open(solution_file, "r") as file:
+            content = file.read()
 
-    with open(solution_file, "w") as file:
-        file.write("\n".join(lines))
+        lines = content.splitlines()
+        err_lines = [f"{GRADER_TOKEN} {line}" for line in str(message).split("\n")]
+        points_to_reduce = round(points_to_reduce, 1)
+        points = -points_to_reduce
+        err_lines.append(f"{GRADER_TOKEN} {points} points")
+        lines.extend(err_lines)
+
+        atomic_write(solution_file, "\n".join(lines))
+        return points
+
+
+def _record_deduction(score_fixture, function_name, message, points_to_reduce):
+    # keep a record of the deduction, so that the conftest plugin can report it per test
+    score_fixture.setdefault("deductions", []).append(
+        {
+            "function": function_name,
+            "message": summarize_message(message),
+            "points_to_reduce": points_to_reduce,
+        }
+    )
+
+
+def deduct_points(
+    solution_file, function_name, message, score_fixture, points_to_reduce: float
+):
+    """
+    Like `update_assignment`, for callers that have the name of the solution file and of the graded function
+    rather than the loaded objects. Falls back to a note at the end of the file if there is no such function.
+    """
+    _record_deduction(score_fixture, function_name, message, points_to_reduce)
+    points = None
+    if function_name is not None:
+        points = annotate_function(
+            solution_file, function_name, message, points_to_reduce
+        )
+    if points is None:
+        points = annotate_file(solution_file, message, points_to_reduce)
+    score_fixture["total"] += points
 
 
 def update_assignment(
     solution, function, message, score_fixture, points_to_reduce: float
 ):
+    _record_deduction(
+        score_fixture,
+        None if function is None else function.__name__,
+        message,
+        points_to_reduce,
+    )
     if function is not None:
         _update_assignment_function(
             solution,
@@ -96,18 +250,8 @@ def update_assignment(
         )
 
 
-def cleanup_grader_notes(fn: str) -> str:
-    """
-    Removes all grader notes from the specified function in the specified Python file.
-
-    Args:
-        fn: str, the name of the function to be cleaned.
-
-    Returns:
-        str, the cleaned function code.
-    """
-    with open(fn, "r") as file:
-        lines_in = file.readlines()
+def strip_grader_notes(lines_in: list) -> list:
+    """Returns `lines_in` without the grader notes."""
     lines_out = []
     for line in lines_in:
         if GRADER_TOKEN not in line:
@@ -118,11 +262,56 @@ def cleanup_grader_notes(fn: str) -> str:
         else:
             # remove the grader note
             lines_out.append(line.split(GRADER_TOKEN)[0])
-    with open(fn, "w") as file:
-        file.write("".join(lines_out))
+    return lines_out
+
+
+def cleanup_grader_notes(fn: str) -> str:
+    """
+    Removes all grader notes from the specified function in the specified Python file.
+
+    Args:
+        fn: str, the name of the function to be cleaned.
+
+    Returns:
+        str, the cleaned function code.
+    """
+    with locked_file(fn):
+        with open(fn, "r") as file:
+            lines_in = file.readlines()
+        lines_out = strip_grader_notes(lines_in)
+        atomic_write(fn, "".join(lines_out))
     return "".join(lines_out)
 
 
+def cleanup_grader_notes_if_present(fn: str) -> int:
+    """
+    Removes all grader notes from the specified Python file, leaving files without notes untouched.
+
+    Args:
+        fn: str, the name of the file to be cleaned.
+
+    Returns:
+        int, the number of lines that were removed or changed.
+    """
+    with open(fn, "rb") as file:
+        content = file.read()
+    if GRADER_TOKEN.encode("utf-8") not in content:
+        return 0
+    with locked_file(fn):
+        # re-read under the lock, the file may have changed since it was scanned
+        with open(fn, "rb") as file:
+            content = file.read()
+        # the bytes that are not utf-8 are written back as they were
+        lines_in = content.decode("utf-8", errors="surrogateescape").splitlines(
+            keepends=True
+        )
+        lines_out = strip_grader_notes(lines_in)
+        n_changed = sum(GRADER_TOKEN in line for line in lines_in)
+        if n_changed:
+            atomic_write(fn, "".join(lines_out), errors="surrogateescape")
+    return n_changed
+
+
 def author_id_from_file(fn: str) -> str:
     author_id = "UNKNOWN"
     lines = open(fn, "r").readlines()
@@ -144,11 +333,38 @@ def author_id_from_file(fn: str) -> str:
     return author_id
 
 
+def grader_points(lines) -> list:
+    """The points (negative for deductions) of the grader notes in `lines`, in order."""
+    rex = re.escape(GRADER_TOKEN) + r".*?(-?\d+(\.\d+)?)(?=\s*points)"
+    ret = []
+    for line in lines:
+        match = re.search(rex, line)
+        if match:
+            ret.append(float(match.group(1)))
+    return ret
+
+
+def total_points(
+    starting_points: float, points: list, score_floor: float = None
+) -> int:
+    """
+    The total of a submission, given the points of its grader notes, and not below `score_floor` if it is
+    given (see grading_spec.py).
+    """
+    total = starting_points
+    for d in points:
+        total += d
+    if score_floor is not None:
+        total = max(total, score_floor)
+    return int(round(total))
+
+
 def sum_up_grader_points(
     fn: str,
     starting_points=100,
     quiet=False,
     output_file: str = None,
+    score_floor: float = None,
 ) -> (str, float):
     """
     Sums up the grader points in the specified Python file.
@@ -159,22 +375,16 @@ def sum_up_grader_points(
         quiet: bool, if True, suppress all output.
         output_file: str, the name of the file to write the output to. The file is csv format, each line is appended
         to the file.
+        score_floor: float, the lowest total, if any.
     Returns:
         int, the total number of grader points in the file.
     """
     with open(fn, "r") as file:
-        lines = file.readlines()
+        points = grader_points(file)
 
     author_id = author_id_from_file(fn)
-    total = starting_points
-    for line in lines:
-        rex = re.escape(GRADER_TOKEN) + r".*?(-?\d+(\.\d+)?)(?=\s*points)"
-        match = re.search(rex, line)
-        if match:
-            d = float(match.group(1))
-            total += d
+    total = total_points(starting_points, points, score_floor)
     fn_str = os.path.splitext(os.path.basename(fn))[0]
-    total = int(np.round(total, 0))
     if not quiet:
         print(f"{fn_str:<30s}, author_id: {author_id:<20s}, total: {total}")
     if output_file:
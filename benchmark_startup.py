@@ -0,0 +1,81 @@
+"""
+Measures the fixed start-up cost paid by every grading invocation and every grading worker:
+importing the grader modules, and running pytest on a submission.
+
+Usage:
+
+  python benchmark_startup.py -n 10
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import shutil
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _time_command(cmd, n_runs, env=None):
+    durations = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=HERE, capture_output=True, env=env)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def benchmark_startup(
+    *,
+    n_runs: int = 10,
+    file_with_tests: str = "sample_tests.py",
+    solution_file: str = "sample_solution.py",
+    disable_plugin_autoload: bool = False,
+):
+    """
+    Prints the median and the minimum wall-clock time of the grader's start-up steps.
+
+    Args:
+        n_runs: int, the number of times to run each step.
+        file_with_tests: str, the test file to run pytest on.
+        solution_file: str, the solution to run the tests against. It is copied to a temporary
+        file first, because grading annotates the file it grades.
+        disable_plugin_autoload: bool, if True, run pytest without loading the installed plugins, as
+        `grade_file(disable_plugin_autoload=True)` does.
+    """
+    from grade import pytest_env
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_solution = os.path.join(tmp_dir, os.path.basename(solution_file))
+        shutil.copy(os.path.join(HERE, solution_file), tmp_solution)
+        steps = {
+            "python": ([sys.executable, "-c", "pass"], None),
+            "import grade": ([sys.executable, "-c", "import grade"], None),
+            "import conftest": ([sys.executable, "-c", "import conftest"], None),
+            "pytest (collect only)": (
+                [
+                    sys.executable,
+                    "-m",
+                    "pytest",
+                    "--collect-only",
+                    "-q",
+                    file_with_tests,
+                    "--solution",
+                    tmp_solution,
+                ],
+                pytest_env(disable_plugin_autoload),
+            ),
+        }
+        for name, (cmd, env) in steps.items():
+            durations = _time_command(cmd, n_runs, env=env)
+            print(
+                f"{name:<25s} median: {statistics.median(durations) * 1000:8.1f} ms, "
+                f"min: {min(durations) * 1000:8.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    import defopt
+
+    defopt.run(benchmark_startup, short={"n-runs": "n"})
@@ -1,13 +1,12 @@
 import json
-import os
 from typing import Literal
 
-from dotenv import load_dotenv
-from openai import OpenAI  # pip install openai
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import textwrap
+import threading
 
-openai_client = None
+from grading_backends import GradingBackend, get_grading_backend
+from progress import progress, showing_progress
 
 
 def split_long_line_keep_newlines(s: str, n_chars=100) -> str:
@@ -16,7 +15,7 @@ def split_long_line_keep_newlines(s: str, n_chars=100) -> str:
     return "\n".join(wrapped_lines)
 
 
-system_message = """
+grading_header = """
 You are an exercise grader tasked with evaluating student submissions. 
 Setting aside any prior knowledge on the subject and focus solely on the 
 student's response and the reference answer provided. 
@@ -35,14 +34,9 @@ Reference Answer:
 {REFERENCE_ANSWER}
 </reference_answer>
 
-Student's Response:
-<response>
-{RESPONSE}
-</response>
-
-Your feedback should be structured in JSON format, encompassing the following 
-keys and associated values:
+"""
 
+grading_keys_description = """
  - `valid`: one of ["empty", "only irrelevant", "valid"], indicating whether the response is empty or 
     only contains irrelevant information, or is a valid attempt at answering the question.
  
@@ -79,6 +73,84 @@ keys and associated values:
 
 """
 
+system_message = (
+    grading_header
+    + """Student's Response:
+<response>
+{RESPONSE}
+</response>
+
+Your feedback should be structured in JSON format, encompassing the following 
+keys and associated values:
+"""
+    + grading_keys_description
+)
+
+batch_system_message = (
+    grading_header
+    + """Student Responses:
+{RESPONSES}
+
+Grade each of the responses above independently of the others. 
+Your feedback should be structured in JSON format, as an object with a single key 
+`verdicts` whose value is a JSON array with exactly one entry per response, in the 
+same order as the responses. Each entry should contain the key `id` (the id of the 
+response it refers to) and the following keys and associated values:
+"""
+    + grading_keys_description
+)
+
+batch_response_template = """<response id="{ID}">
+{RESPONSE}
+</response>
+"""
+
+
+# The values `get_grade_from_grading_response` knows how to score, per key
+grading_response_values = {
+    "valid": {"empty", "only irrelevant", "valid", "ok"},
+    "gross mistakes": {"absent", "present"},
+    "accuracy": {"accurate", "mostly accurate", "mostly inaccurate", "inaccurate"},
+    "completeness": {"complete", "mostly complete", "partial", "incomplete"},
+    "relevance": {"relevant", "mostly relevant", "mostly irrelevant", "irrelevant"},
+    "overall quality": {"good", "ok", "low"},
+}
+
+# Running totals of the (estimated) prompt tokens sent by the batched grading mode
+token_usage = {"batched": 0, "unbatched_equivalent": 0}
+token_usage_lock = threading.Lock()
+
+
+def estimate_tokens(text: str) -> int:
+    # rough estimate, about four characters per token for English text
+    return len(text) // 4
+
+
+def is_valid_grading_response(grading_response) -> bool:
+    """
+    Returns True if `grading_response` can be scored by `get_grade_from_grading_response`. Only the keys it
+    reads are required: a response that is not valid (e.g. empty) is scored from the "valid" key alone.
+    """
+    if not isinstance(grading_response, dict):
+        return False
+    validity = grading_response.get("valid")
+    if not isinstance(validity, str):
+        return False
+    validity = validity.lower()
+    if validity not in grading_response_values["valid"]:
+        return False
+    if validity not in {"valid", "ok"}:
+        return True
+    for key, allowed in grading_response_values.items():
+        if key == "valid":
+            continue
+        value = grading_response.get(key)
+        if key == "gross mistakes" and value is None:
+            continue  # defaults to absent
+        if not isinstance(value, str) or value not in allowed:
+            return False
+    return True
+
 
 def get_grade_from_grading_response(grading_response):
     assert isinstance(grading_response, dict)
@@ -161,31 +233,106 @@ def get_grade_from_grading_response(grading_response):
     return {"grade": points, "feedback": feedback}
 
 
-def openai_grade_student_response(question, correct_answer, student_response):
-    global openai_client
-    if openai_client is None:
-        load_dotenv()
-        openai_api_key = os.getenv("OPENAI_API_KEY")
-        openai_org_id = os.getenv("OPENAI_ORG_ID", None)
-        openai_client = OpenAI(api_key=openai_api_key, organization=openai_org_id)
+def openai_grade_student_response(
+    question, correct_answer, student_response, backend: GradingBackend = None
+):
+    if backend is None:
+        backend = get_grading_backend()
 
     formatted_system_message = system_message.format(
         QUESTION=question, REFERENCE_ANSWER=correct_answer, RESPONSE=student_response
     )
-    chat_completion = openai_client.chat.completions.create(
-        messages=[
-            {"role": "system", "content": formatted_system_message},
-        ],
-        model="gpt-3.5-turbo",
-        response_format={"type": "json_object"},
-    )
     # Assuming the grading logic returns JSON as string in the response
-    resp = chat_completion.choices[0].message.content
+    with progress.llm_call():
+        resp = backend.complete(formatted_system_message)
     try:
         grade_info = json.loads(resp)
     except json.JSONDecodeError:
         grade_info = resp
     ret = get_grade_from_grading_response(grade_info)
+    ret["verdict"] = grade_info
+    return ret
+
+
+def openai_grade_student_responses_batch(
+    question,
+    correct_answer,
+    student_responses,
+    backend: GradingBackend = None,
+    n_retries_on_error: int = 3,
+) -> list:
+    """
+    Grades several responses to the same question with a single request, so that the question and the
+    reference answer are sent once instead of once per response. Verdicts that are missing or malformed are
+    re-graded one by one with `openai_grade_student_response`, with up to `n_retries_on_error` attempts each.
+    `backend` defaults to the shared grading backend.
+
+    Returns:
+        list: one grade dict per student response, in the order of `student_responses`, or None for the
+        responses that could not be graded.
+    """
+    if backend is None:
+        backend = get_grading_backend()
+
+    responses = "".join(
+        batch_response_template.format(ID=i, RESPONSE=student_response)
+        for i, student_response in enumerate(student_responses, start=1)
+    )
+    formatted_system_message = batch_system_message.format(
+        QUESTION=question, REFERENCE_ANSWER=correct_answer, RESPONSES=responses
+    )
+    with progress.llm_call():
+        resp = backend.complete(formatted_system_message)
+    try:
+        verdicts = json.loads(resp).get("verdicts", [])
+    except (json.JSONDecodeError, AttributeError):
+        verdicts = []
+    if not isinstance(verdicts, list):
+        verdicts = []
+    # index the verdicts by id, falling back to their position when the id is missing or garbled
+    verdicts_by_id = {}
+    for position, verdict in enumerate(verdicts, start=1):
+        if not isinstance(verdict, dict):
+            continue
+        verdict_id = verdict.get("id", position)
+        try:
+            verdict_id = int(verdict_id)
+        except (TypeError, ValueError):
+            verdict_id = position
+        verdicts_by_id.setdefault(verdict_id, verdict)
+
+    batched_tokens = estimate_tokens(formatted_system_message)
+    unbatched_tokens = 0
+    ret = []
+    for i, student_response in enumerate(student_responses, start=1):
+        single_tokens = estimate_tokens(
+            system_message.format(
+                QUESTION=question,
+                REFERENCE_ANSWER=correct_answer,
+                RESPONSE=student_response,
+            )
+        )
+        unbatched_tokens += single_tokens
+        verdict = verdicts_by_id.get(i)
+        if is_valid_grading_response(verdict):
+            ret.append(dict(get_grade_from_grading_response(verdict), verdict=verdict))
+        else:
+            batched_tokens += single_tokens
+            # an error grading one response must not throw away the verdicts of the others
+            ret.append(
+                parallel_grade(
+                    (
+                        question,
+                        correct_answer,
+                        student_response,
+                        n_retries_on_error,
+                        backend,
+                    )
+                )
+            )
+    with token_usage_lock:
+        token_usage["batched"] += batched_tokens
+        token_usage["unbatched_equivalent"] += unbatched_tokens
     return ret
 
 
@@ -193,11 +340,11 @@ def parallel_grade(attempt_args):
     """
     Wrapper function to call `openai_grade_student_response` with retries.
     """
-    question, correct_answer, student_response, n_retries = attempt_args
+    question, correct_answer, student_response, n_retries, backend = attempt_args
     for _ in range(n_retries):
         try:
             return openai_grade_student_response(
-                question, correct_answer, student_response
+                question, correct_answer, student_response, backend=backend
             )
         except Exception as e:
             print(f"Error grading response: {e}")
@@ -214,9 +361,11 @@ def grade_student_response(
     include_correct_answer: bool = True,
     n_jobs: int = 3,
     round_up: bool = True,
+    backend: GradingBackend = None,
+    progress_port: int = None,
 ) -> dict:
     """
-    Grade a student's response to a given question, utilizing the OpenAI API to generate multiple grades
+    Grade a student's response to a given question, utilizing a language model to generate multiple grades
     and selecting the final grade based on the specified strategy. Supports parallel grading.
 
     Args:
@@ -230,16 +379,29 @@ def grade_student_response(
         include_correct_answer (bool): Whether to include the correct answer in the grading request. Defaults to True.
         n_jobs (int): The number of parallel jobs to use for grading. Defaults to 1.
         round_up (bool): Whether to round up the final grade to the nearest 5. Defaults to True.
+        backend (GradingBackend): The model backend to grade with. Defaults to the shared grading backend.
+        progress_port (int): If given, the language model calls (see progress.py) are served as JSON on
+            http://127.0.0.1:<progress_port> while grading. Defaults to None.
 
     Returns:
         dict: The final grading decision, containing the grade and feedback.
     """
+    if backend is None:
+        backend = get_grading_backend()
     grades = []
-    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+    with showing_progress(display=False, port=progress_port), ThreadPoolExecutor(
+        max_workers=n_jobs
+    ) as executor:
         futures = [
             executor.submit(
                 parallel_grade,
-                (question, correct_answer, student_response, n_retries_on_error),
+                (
+                    question,
+                    correct_answer,
+                    student_response,
+                    n_retries_on_error,
+                    backend,
+                ),
             )
             for _ in range(n_grades)
         ]
@@ -251,11 +413,39 @@ def grade_student_response(
     if not grades:
         raise Exception("Failed to grade after multiple attempts.")
 
+    return _select_final_grade(
+        grades,
+        correct_answer=correct_answer,
+        n_grades=n_grades,
+        grade_strategy=grade_strategy,
+        include_correct_answer=include_correct_answer,
+        round_up=round_up,
+    )
+
+
+def _select_final_grade(
+    grades,
+    *,
+    correct_answer: str,
+    n_grades: int,
+    grade_strategy: Literal["best", "worst"],
+    include_correct_answer: bool,
+    round_up: bool,
+) -> dict:
     if grade_strategy == "best":
         final_grade = max(grades, key=lambda x: x["grade"])
     else:  # worst
         final_grade = min(grades, key=lambda x: x["grade"])
 
+    # keep the raw verdicts, so that `regrade_from_verdicts` can recompute the grade without the model
+    final_grade["replay"] = {
+        "verdicts": [g.get("verdict") for g in grades],
+        "n_grades": n_grades,
+        "grade_strategy": grade_strategy,
+        "round_up": round_up,
+    }
+    final_grade.pop("verdict", None)
+
     final_grade[
         "more details"
     ] = f'{grade_strategy} of {n_grades} grades: {[g["grade"] for g in grades]}'
@@ -276,6 +466,177 @@ def grade_student_response(
     return final_grade
 
 
+def regrade_from_verdicts(grade_info: dict) -> dict:
+    """
+    Recomputes a grading decision of `grade_student_response` from the raw verdicts stored in it, without calling
+    the model, e.g. to see the effect of a change of `get_grade_from_grading_response`.
+
+    Args:
+        grade_info (dict): The grading decision, as returned by `grade_student_response`.
+
+    Returns:
+        dict: The new grading decision.
+    """
+    replay = grade_info["replay"]
+    grades = [
+        dict(get_grade_from_grading_response(verdict), verdict=verdict)
+        for verdict in replay["verdicts"]
+    ]
+    return _select_final_grade(
+        grades,
+        correct_answer=grade_info.get("correct_answer"),
+        n_grades=replay["n_grades"],
+        grade_strategy=replay["grade_strategy"],
+        include_correct_answer="correct_answer" in grade_info,
+        round_up=replay["round_up"],
+    )
+
+
+def parallel_grade_batch(attempt_args):
+    """
+    Wrapper function to call `openai_grade_student_responses_batch` with retries.
+    """
+    question, correct_answer, student_responses, n_retries, backend = attempt_args
+    for _ in range(n_retries):
+        try:
+            return openai_grade_student_responses_batch(
+                question,
+                correct_answer,
+                student_responses,
+                backend=backend,
+                n_retries_on_error=n_retries,
+            )
+        except Exception as e:
+            print(f"Error grading responses: {e}")
+    return None
+
+
+def grade_student_responses(
+    question: str,
+    correct_answer: str,
+    student_responses: list,
+    batch_size: int = 10,
+    n_retries_on_error: int = 3,
+    n_grades: int = 3,
+    grade_strategy: Literal["best", "worst"] = "best",
+    include_correct_answer: bool = True,
+    n_jobs: int = 3,
+    round_up: bool = True,
+    quiet: bool = False,
+    backend: GradingBackend = None,
+    progress_port: int = None,
+) -> list:
+    """
+    Batched version of `grade_student_response`: grades many responses to the same question, packing up to
+    `batch_size` responses into every request.
+
+    Args:
+        question (str): The question that was asked to the students.
+        correct_answer (str): The reference or correct answer to the question.
+        student_responses (list): The responses provided by the students.
+        batch_size (int): The maximal number of responses to grade in a single request. Defaults to 10.
+        n_retries_on_error (int): The number of attempts to retry grading if an error occurs. Defaults to 3.
+        n_grades (int): The number of grades to generate per response before deciding on the final grade.
+            Defaults to 3.
+        grade_strategy (Literal["best", "worst"]): Strategy to determine the final grade. 'best' for the highest
+            grade and 'worst' for the lowest. Defaults to "best".
+        include_correct_answer (bool): Whether to include the correct answer in the grading result. Defaults to True.
+        n_jobs (int): The number of parallel jobs to use for grading. Defaults to 3.
+        round_up (bool): Whether to round up the final grade to the nearest 5. Defaults to True.
+        quiet (bool): If True, do not show the language model calls in flight (see progress.py) nor print the
+            number of tokens saved by batching. Defaults to False.
+        backend (GradingBackend): The model backend to grade with. Defaults to the shared grading backend.
+        progress_port (int): If given, the language model calls are also served as JSON on
+            http://127.0.0.1:<progress_port> while grading. Defaults to None.
+
+    Returns:
+        list: The final grading decisions, one dict per student response, in the order of `student_responses`,
+            or None for the responses that could not be graded after multiple attempts.
+    """
+    if backend is None:
+        backend = get_grading_backend()
+    tokens_before = dict(token_usage)
+    batches = [
+        list(range(start, min(start + batch_size, len(student_responses))))
+        for start in range(0, len(student_responses), batch_size)
+    ]
+    grades = [[] for _ in student_responses]
+    with showing_progress(display=not quiet, port=progress_port), ThreadPoolExecutor(
+        max_workers=n_jobs
+    ) as executor:
+        futures = {
+            executor.submit(
+                parallel_grade_batch,
+                (
+                    question,
+                    correct_answer,
+                    [student_responses[i] for i in batch],
+                    n_retries_on_error,
+                    backend,
+                ),
+            ): batch
+            for batch in batches
+            for _ in range(n_grades)
+        }
+        for future in as_completed(futures):
+            result = future.result()
+            if result:
+                for i, grade in zip(futures[future], result):
+                    if grade is not None:
+                        grades[i].append(grade)
+
+    ret = []
+    for response_grades in grades:
+        if not response_grades:
+            # failed after multiple attempts, keep the grades of the other responses
+            ret.append(None)
+            continue
+        ret.append(
+            _select_final_grade(
+                response_grades,
+                correct_answer=correct_answer,
+                n_grades=n_grades,
+                grade_strategy=grade_strategy,
+                include_correct_answer=include_correct_answer,
+                round_up=round_up,
+            )
+        )
+
+    if not quiet:
+        batched = token_usage["batched"] - tokens_before["batched"]
+        unbatched = (
+            token_usage["unbatched_equivalent"] - tokens_before["unbatched_equivalent"]
+        )
+        print(
+            f"Prompt tokens (estimated): {batched} batched instead of {unbatched}, "
+            f"saved {unbatched - batched}"
+        )
+    return ret
+
+
+_feedback_file_lock = threading.Lock()
+
+
+def save_open_question_feedback(
+    feedback_file: str, *, submission_id: str, question: str, grade_info: dict
+):
+    """
+    Appends the grading decision of a student's response as a line of the jsonl `feedback_file`, which
+    `lms_export.export_to_lms` merges into the feedback of the submission.
+
+    Args:
+        feedback_file (str): The jsonl file to append to.
+        submission_id (str): The id of the submission, as in the summary.csv of the graded folder, or the name of
+            the submission file without its extension when its id is unknown (UNKNOWN_SUBMISSION_ID).
+        question (str): A short name of the question, used as the column name in the exported grades.
+        grade_info (dict): The grading decision, as returned by `grade_student_response`.
+    """
+    line = json.dumps(dict(grade_info, submission_id=submission_id, question=question))
+    with _feedback_file_lock:
+        with open(feedback_file, "a") as file:
+            file.write(line + "\n")
+
+
 if __name__ == "__main__":
     # Call the function with the example inputs
 
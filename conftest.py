@@ -1,16 +1,44 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # Time-stamp: <2015-05-22 00:58 ycopin@lyonovae03.in2p3.fr>
-import warnings
+import inspect
+import json
+import signal
+import threading
+from collections import Counter
+from contextlib import contextmanager
 
-import numpy as np
 import pytest
-from importlib.machinery import SourceFileLoader
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from assignment_updater import deduct_points, load_source
+from grading_spec import load_grading_spec
+from prefilter import graded_tests, test_dependencies
 
 
 # Initialize a global score
 score = {"total": 100}  # Use a dict to allow modifications
 
+# Per-test outcomes and the deductions made by each test, written to --results-file
+results = {}
+
+# The grading spec given with --grading-spec, if any
+grading_spec = None
+
+# The names of the tests each test depends on, see prefilter.test_dependencies
+dependencies = {}
+
+# The modules loaded from the --solution and --reference files
+_modules = {}
+
+# The attributes of the solution replaced by the reference implementation for the current test
+_reference_patches = pytest.StashKey[list]()
+_MISSING = object()
+
 
 @pytest.fixture(scope="session")
 def score_fixture():
@@ -19,25 +47,251 @@ def score_fixture():
     return score
 
 
-def load_source(what, path):
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        solution = SourceFileLoader(what, path).load_module()
-
-    return solution
-
-
 def pytest_addoption(parser):
     """Add a custom command-line option to py.test."""
 
     parser.addoption("--exam", help="Code file to be tested.")
     parser.addoption("--solution", help="Solution file.")
+    parser.addoption(
+        "--results-file", help="JSON file to write the per-test results to."
+    )
+    parser.addoption(
+        "--grading-spec",
+        help="TOML or YAML file with the points, timeouts and target functions of the tests.",
+    )
+    parser.addoption(
+        "--reference",
+        help="Reference implementation, used in place of the failing functions other tests depend on.",
+    )
+    parser.addoption(
+        "--memory-limit",
+        type=int,
+        help="Maximal memory (address space) of the test process, in MB.",
+    )
+    parser.addoption(
+        "--failed-tests",
+        help="Comma-separated tests already graded as failed, e.g. unimplemented functions.",
+    )
+
+
+def pytest_configure(config):
+    global grading_spec
+    config.addinivalue_line(
+        "markers", "depends_on(*test_names): the tests this test depends on"
+    )
+    memory_limit = config.getoption("--memory-limit")
+    if memory_limit and resource is not None:
+        # a submission that allocates without end gets a MemoryError instead of taking the machine down
+        limit = memory_limit * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    fn = config.getoption("--grading-spec")
+    if fn:
+        grading_spec = load_grading_spec(fn)
+        score["total"] = grading_spec.starting_points
+
+
+def _test_name(item):
+    return getattr(item, "originalname", None) or item.name
+
+
+def _test_spec(item):
+    if grading_spec is None:
+        return None
+    return grading_spec.tests.get(_test_name(item))
+
+
+def _load_module(config, option, what):
+    if option not in _modules:
+        _modules[option] = load_source(what=what, path=config.getoption(option))
+    return _modules[option]
+
+
+def pytest_collection_modifyitems(session, config, items):
+    for item in items:
+        prerequisites = dependencies.setdefault(_test_name(item), set())
+        if item.path.suffix == ".py":
+            prerequisites |= test_dependencies(
+                str(item.path), config.getoption("--grading-spec")
+            ).get(_test_name(item), set())
+        for marker in item.iter_markers("depends_on"):
+            prerequisites |= set(marker.args)
+    if grading_spec is not None:
+        # run the expensive tests last, they are the ones skipped once the score floor is reached
+        items.sort(key=lambda item: getattr(_test_spec(item), "cost", 1))
+    # run the prerequisites first, otherwise keep the order (the first remaining test breaks a cycle)
+    remaining = Counter(_test_name(item) for item in items)
+    pending = list(items)
+    items.clear()
+    while pending:
+        ready = next(
+            (
+                item
+                for item in pending
+                if not any(remaining[name] for name in dependencies[_test_name(item)])
+            ),
+            pending[0],
+        )
+        pending.remove(ready)
+        items.append(ready)
+        remaining[_test_name(ready)] -= 1
+
+
+def _has_failed(config, test_name):
+    failed_tests = (config.getoption("--failed-tests") or "").split(",")
+    if test_name in failed_tests:
+        return True
+    result = results.get(test_name)
+    return result is not None and (
+        result["outcome"] != "passed" or bool(result["deductions"])
+    )
+
+
+def _patch_with_reference(solution, reference, target):
+    *path, attr = target.split(".")
+    owner, reference_owner = solution, reference
+    for name in path:
+        owner, reference_owner = getattr(owner, name), getattr(reference_owner, name)
+    patch = (owner, attr, vars(owner).get(attr, _MISSING))
+    setattr(owner, attr, inspect.getattr_static(reference_owner, attr))
+    return patch
+
+
+def _restore(patches):
+    for owner, attr, original in reversed(patches):
+        if original is _MISSING:
+            delattr(owner, attr)
+        else:
+            setattr(owner, attr, original)
+
+
+def _use_reference(item, failed):
+    """
+    Replaces the target functions of the `failed` tests by their reference implementation for the duration of
+    `item`. If that is not possible, the points of `item` are deducted and it is skipped without running.
+    """
+    config = item.config
+    targets = graded_tests(str(item.path), config.getoption("--grading-spec"))
+    if config.getoption("--reference"):
+        patches = []
+        try:
+            solution = _load_module(config, "--solution", "solution")
+            reference = _load_module(config, "--reference", "reference")
+            for target in {
+                targets[name].target for name in failed if targets.get(name)
+            }:
+                patches.append(_patch_with_reference(solution, reference, target))
+        except (AttributeError, TypeError):
+            _restore(patches)
+        else:
+            item.stash[_reference_patches] = patches
+            return
+
+    graded_test = targets.get(_test_name(item))
+    test_spec = _test_spec(item)
+    if graded_test is None and test_spec is None:
+        return  # nothing to deduct, let it run
+    message = f"Not run, it depends on {', '.join(failed)}"
+    deduct_points(
+        config.getoption("--solution"),
+        graded_test.target.split(".")[-1] if graded_test else None,
+        message,
+        score,
+        test_spec.points if test_spec else graded_test.points,
+    )
+    pytest.skip(message)
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_runtest_setup(item):
+    if (
+        _test_spec(item) is not None
+        and grading_spec.score_floor is not None
+        and score["total"] <= grading_spec.score_floor
+    ):
+        pytest.skip("The score floor was reached")
+    failed = sorted(
+        name
+        for name in dependencies.get(_test_name(item), ())
+        if _has_failed(item.config, name)
+    )
+    if failed:
+        _use_reference(item, failed)
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_teardown(item, nextitem):
+    yield
+    _restore(item.stash.get(_reference_patches, []))
+
+
+class GradingTimeout(Exception):
+    pass
+
+
+@contextmanager
+def _time_limit(timeout):
+    if (
+        not timeout
+        or not hasattr(signal, "SIGALRM")
+        or threading.current_thread() is not threading.main_thread()
+    ):
+        yield
+        return
+
+    def on_alarm(signum, frame):
+        raise GradingTimeout(f"Timed out after {timeout} seconds")
+
+    previous = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_call(item):
+    test_spec = _test_spec(item)
+    with _time_limit(test_spec.timeout if test_spec else None):
+        yield
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item, call):
+    """Deducts the points of the failing tests that are in the grading spec."""
+    outcome = yield
+    report = outcome.get_result()
+    test_spec = _test_spec(item)
+    if test_spec is None or not report.failed or call.when == "teardown":
+        return
+    message = str(call.excinfo.value) or call.excinfo.exconly()
+    function_name = test_spec.function.split(".")[-1] if test_spec.function else None
+    deduct_points(
+        item.config.getoption("--solution"),
+        function_name,
+        message,
+        score,
+        test_spec.points,
+    )
+    # the failure was graded, it is not a problem with the test itself
+    if call.when == "call":
+        report.outcome = "passed"
+        report.longrepr = None
+    else:
+        # e.g. a fixture that uses a broken part of the submission
+        report.outcome = "skipped"
+        report.longrepr = (
+            item.location[0],
+            item.location[1],
+            f"{message} (-{test_spec.points} points)",
+        )
 
 
 @pytest.fixture(scope="session")
 def solution(request):
     """Import code specified with command-line custom option '--solution'."""
-    soluce = load_source(what="solution", path=request.config.getoption("--solution"))
+    soluce = _load_module(request.config, "--solution", "solution")
     return soluce
 
 
@@ -53,6 +307,24 @@ def exam(request):
     return code
 
 
+def pytest_runtest_logreport(report):
+    test_name = report.nodeid.split("::")[-1]
+    result = results.setdefault(test_name, {"outcome": "passed", "deductions": []})
+    if report.failed:
+        result["outcome"] = "failed" if report.when == "call" else "error"
+    elif report.skipped:
+        result["outcome"] = "skipped"
+    result["duration"] = round(result.get("duration", 0) + report.duration, 4)
+    result["deductions"].extend(score.pop("deductions", []))
+
+
 def pytest_sessionfinish(session, exitstatus):
-    remaining = np.round(score["total"], 1)
+    remaining = score["total"]
+    if grading_spec is not None and grading_spec.score_floor is not None:
+        remaining = max(remaining, grading_spec.score_floor)
+    remaining = round(remaining, 1)
     print(f"\nRemaining Score: {remaining}")
+    results_file = session.config.getoption("--results-file")
+    if results_file:
+        with open(results_file, "w") as file:
+            json.dump(results, file)
@@ -1,17 +1,27 @@
+import json
 import os
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import subprocess
+import tempfile
+import threading
+import time
 from datetime import datetime
 from typing import Literal
 
-import defopt
-from tqdm.auto import tqdm
-
 from assignment_updater import (
+    annotate_function,
     cleanup_grader_notes,
+    cleanup_grader_notes_if_present,
+    grader_points,
+    locked_file,
     sum_up_grader_points,
     author_id_from_file,
 )
+from grading_spec import load_grading_spec
+from prefilter import prefilter_submission
+from progress import progress, showing_progress
+from results_cache import apply_cached_results, get_results_cache, store_results
+from scheduling import load_durations, schedule, unmatched_priority
 
 #########
 
@@ -29,6 +39,106 @@ def change_dir(destination):
         os.chdir(prev_dir)
 
 
+def pytest_env(disable_plugin_autoload: bool = False) -> dict:
+    """
+    The environment of the pytest runs. Skipping the discovery of the installed plugins (xdist etc.) saves a
+    good part of the fixed start-up cost of every run, but only suits test files that need no plugin fixture
+    (e.g. `mocker`) beyond our conftest plugin.
+    """
+    env = dict(os.environ)
+    if disable_plugin_autoload:
+        env.setdefault("PYTEST_DISABLE_PLUGIN_AUTOLOAD", "1")
+    return env
+
+
+# The bytes kept of the stdout and of the stderr of a pytest run, a submission may print without end
+MAX_CAPTURED_OUTPUT = 64 * 1024
+
+
+def _read_capped(pipe, max_bytes: int, outputs: dict, name: str):
+    # keep the first and the last max_bytes / 2 bytes, the middle is counted and dropped
+    half = max_bytes // 2
+    head, tail, n_bytes = bytearray(), bytearray(), 0
+    for chunk in iter(lambda: pipe.read(65536), b""):
+        n_bytes += len(chunk)
+        if len(head) < half:
+            n_head = half - len(head)
+            head += chunk[:n_head]
+            chunk = chunk[n_head:]
+        tail += chunk
+        if len(tail) > half:
+            del tail[: len(tail) - half]
+    pipe.close()
+    n_dropped = n_bytes - len(head) - len(tail)
+    if n_dropped:
+        head += f"\n[... {n_dropped} bytes truncated ...]\n".encode("utf-8")
+    outputs[name] = bytes(head + tail)
+
+
+def _run_capped(
+    cmd: list, *, env: dict = None, timeout: float = None, max_output: int = None
+) -> subprocess.CompletedProcess:
+    """
+    Like `subprocess.run(cmd, capture_output=True)`, but the output is read as it is produced and only
+    `max_output` bytes of each stream are kept (MAX_CAPTURED_OUTPUT by default).
+    """
+    if max_output is None:
+        max_output = MAX_CAPTURED_OUTPUT
+    outputs = {}
+    with subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env
+    ) as process:
+        readers = [
+            threading.Thread(
+                target=_read_capped,
+                args=(pipe, max_output, outputs, name),
+                daemon=True,
+            )
+            for name, pipe in [("stdout", process.stdout), ("stderr", process.stderr)]
+        ]
+        for reader in readers:
+            reader.start()
+        try:
+            process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            raise
+        finally:
+            for reader in readers:
+                reader.join()
+    return subprocess.CompletedProcess(
+        cmd, process.returncode, outputs["stdout"], outputs["stderr"]
+    )
+
+
+def _write_record(
+    record_file: str,
+    file_to_grade: str,
+    start_time: float,
+    status: str,
+    starting_points: float,
+    tests: dict = None,
+    score_floor: float = None,
+):
+    if record_file is None:
+        return
+    with open(file_to_grade, "r") as file:
+        points = grader_points(file)
+    record = {
+        "ts": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "filename": os.path.basename(file_to_grade),
+        "status": status,
+        "duration": round(time.perf_counter() - start_time, 3),
+        "starting_points": starting_points,
+        "grader_points": points,
+        "score_floor": score_floor,
+        "tests": tests,
+    }
+    with locked_file(record_file):
+        with open(record_file, "a") as file:
+            file.write(json.dumps(record) + "\n")
+
+
 def grade_file(
     *,
     file_to_grade: str,
@@ -40,6 +150,14 @@ def grade_file(
     cleanup_only: bool = False,
     black_the_solution: bool = True,
     output_file: str = None,
+    skeleton_file: str = None,
+    results_cache_file: str = None,
+    timeout: float = None,
+    grading_spec: str = None,
+    reference_file: str = None,
+    memory_limit: int = None,
+    record_file: str = None,
+    disable_plugin_autoload: bool = False,
 ):
     """
     Grades the specified Python file.
@@ -54,13 +172,54 @@ def grade_file(
         black_the_solution: bool, if True, run black on the solution file before grading.
         output_file: str, the name of the file to write the output to. The file is jsonl format, each line is appended
         to the file.
+        skeleton_file: str, the skeleton handed to the students. If given, the submission is checked statically
+        first: files that do not parse get 0 points without running pytest, tests of functions left as in the
+        skeleton are marked as failed, and pytest only runs the remaining tests.
+        results_cache_file: str, a jsonl file to cache test results in. If given, tests whose target function is
+        identical to an already graded version get the cached deductions instead of being run again.
+        timeout: float, the maximal time in seconds to run the tests of the file. Files that time out get 0 points.
+        grading_spec: str, a .toml or .yaml grading spec with the points, functions and timeouts of the tests (see
+        grading_spec.py). Its starting points replace `starting_points`, and the total does not drop below its
+        score floor.
+        reference_file: str, a correct implementation. The tests that depend on a failing test (see
+        prefilter.test_dependencies) run with the function of the failing test taken from `reference_file`.
+        Without a reference, they are skipped and lose their points.
+        memory_limit: int, the maximal memory of the pytest process, in MB. Tests of submissions that exceed it
+        fail with a MemoryError. Note that the limit is on the address space, which includes the interpreter
+        and pytest (usually less than 100 MB).
+        record_file: str, a jsonl file to append the grading record of the file to: how the run ended, the points of
+        the grader notes and the per-test results, from which `replay.py` recomputes the points offline.
+        disable_plugin_autoload: bool, if True, pytest does not load the installed plugins, which starts it faster.
+        Only for test files that use no plugin fixture.
     """
 
+    start_time = time.perf_counter()
     file_to_grade = os.path.abspath(file_to_grade)
     assert os.path.exists(file_to_grade), f"File not found: {file_to_grade}"
     assert os.path.exists(file_with_tests), f"Test file not found: {file_with_tests}"
+    extra_args = []
+    score_floor = None
+    if grading_spec is not None:
+        spec = load_grading_spec(grading_spec)
+        starting_points, score_floor = spec.starting_points, spec.score_floor
+        extra_args += ["--grading-spec", os.path.abspath(grading_spec)]
+    if reference_file is not None:
+        extra_args += ["--reference", os.path.abspath(reference_file)]
+    if memory_limit is not None:
+        extra_args += ["--memory-limit", str(memory_limit)]
     if cleanup_first:
         cleanup_grader_notes(file_to_grade)
+    prefiltered = None
+    if skeleton_file is not None and not cleanup_only:
+        prefiltered = prefilter_submission(
+            file_to_grade, file_with_tests, skeleton_file, grading_spec
+        )
+        if allow_failed_tests and prefiltered.syntax_error:
+            # the tests can't load this submission, the same as a failed pytest run below
+            _write_record(
+                record_file, file_to_grade, start_time, "not loadable", starting_points
+            )
+            return author_id_from_file(file_to_grade), 0
     if black_the_solution:
         result = subprocess.run(["black", file_to_grade], capture_output=True)
         if result.returncode:
@@ -68,17 +227,92 @@ def grade_file(
     if cleanup_only:
         return
 
-    result = subprocess.run(
-        [
-            "py.test",
-            file_with_tests,
-            "--solution",
+    test_names = None  # None: run the whole test file
+    failed_tests = []
+    if prefiltered is not None:
+        for graded_test in prefiltered.unimplemented:
+            annotate_function(
+                file_to_grade,
+                graded_test.target.split(".")[-1],
+                f"{graded_test.name}: not implemented",
+                graded_test.points,
+            )
+        test_names = prefiltered.tests_to_run
+        failed_tests += [graded_test.name for graded_test in prefiltered.unimplemented]
+    cache_misses = {}
+    if results_cache_file is not None:
+        results_cache = get_results_cache(results_cache_file)
+        test_names, cache_misses, cached_failures = apply_cached_results(
+            file_to_grade, file_with_tests, test_names, results_cache, grading_spec
+        )
+        failed_tests += cached_failures
+    if failed_tests:
+        # the tests that depend on these run against the reference implementation, as if they failed in this run
+        extra_args += ["--failed-tests", ",".join(failed_tests)]
+    if test_names is None:
+        tests_to_run = [file_with_tests]
+    else:
+        tests_to_run = [f"{file_with_tests}::{test_name}" for test_name in test_names]
+    if not tests_to_run:
+        _write_record(
+            record_file,
             file_to_grade,
-        ],
-        capture_output=True,
-    )
+            start_time,
+            "ok",
+            starting_points,
+            score_floor=score_floor,
+        )
+        return sum_up_grader_points(
+            file_to_grade,
+            starting_points=starting_points,
+            quiet=quiet,
+            output_file=output_file,
+            score_floor=score_floor,
+        )
+
+    results_args = []
+    tests = None
+    if cache_misses or record_file is not None:
+        fd, results_file = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        results_args = ["--results-file", results_file]
+    try:
+        result = _run_capped(
+            [
+                "py.test",
+                *tests_to_run,
+                "--solution",
+                file_to_grade,
+                *results_args,
+                *extra_args,
+            ],
+            env=pytest_env(disable_plugin_autoload),
+            timeout=timeout,
+        )
+        if cache_misses and not result.returncode:
+            store_results(
+                file_with_tests, results_file, cache_misses, results_cache, grading_spec
+            )
+    except subprocess.TimeoutExpired:
+        progress.timeout()
+        if not allow_failed_tests:
+            raise
+        _write_record(
+            record_file, file_to_grade, start_time, "timeout", starting_points
+        )
+        return author_id_from_file(file_to_grade), 0
+    finally:
+        if results_args:
+            if os.path.getsize(results_file):
+                with open(results_file, "r") as file:
+                    tests = json.load(file)
+            os.remove(results_file)
     if result.returncode:
+        progress.crash()
         if allow_failed_tests:
+            _write_record(
+                record_file, file_to_grade, start_time, "crash", starting_points, tests
+            )
             author_id = author_id_from_file(file_to_grade)
             result = (author_id, 0)
         else:
@@ -98,73 +332,127 @@ def grade_file(
             )
             raise ValueError(msg)
     else:
+        _write_record(
+            record_file,
+            file_to_grade,
+            start_time,
+            "ok",
+            starting_points,
+            tests,
+            score_floor=score_floor,
+        )
         result = sum_up_grader_points(
             file_to_grade,
             starting_points=starting_points,
             quiet=quiet,
             output_file=output_file,
+            score_floor=score_floor,
         )
     return result
 
 
-def _grade_folder(
-    *,
-    folder: str,
-    summary_file_strategy: Literal["overwrite", "append", "cancel"] = "overwrite",
-    example_solution_file: str = None,
-    file_with_tests: str = None,
-    starting_points: int = 100,
-    quiet: bool = False,
-    cleanup_first: bool = True,
-    cleanup_only: bool = False,
-    black_the_solution: bool = False,
-    output_file: str = None,
-):
+def submission_files(folder: str) -> list:
+    """Returns the paths of the submissions (the .py files) in `folder`."""
+    return [
+        os.path.join(folder, f) for f in os.listdir(folder) if f.lower().endswith(".py")
+    ]
+
+
+def submission_id_from_filename(fn: str) -> str:
+    basename = os.path.basename(fn)
+    if "WorkCode" in basename:
+        return os.path.splitext(basename)[0].split("WorkCode_")[1].split(".")[0]
+    return "UNKNOWN_SUBMISSION_ID"
+
+
+def _prepare_folder(
+    folder: str, summary_file_strategy: Literal["overwrite", "append", "cancel"]
+) -> dict:
+    """
+    Applies `summary_file_strategy` to the summary of `folder`. Returns the durations of the previous grading
+    of its files, by path, read before the grading record is overwritten.
+    """
     fn_summary = os.path.join(folder, "summary.csv")
+    fn_record = os.path.join(folder, "grading_record.jsonl")
+    durations = {
+        os.path.join(folder, fn): duration
+        for fn, duration in load_durations(fn_record).items()
+    }
     if os.path.exists(fn_summary):
         if summary_file_strategy == "cancel":
             raise ValueError(f"File already exists: {fn_summary}")
         if summary_file_strategy == "overwrite":
             os.remove(fn_summary)
+            if os.path.exists(fn_record):
+                os.remove(fn_record)
+    return durations
 
-    example_solution_file = os.path.abspath(example_solution_file)
-    assert os.path.exists(
-        example_solution_file
-    ), f"File not found: {example_solution_file}"
-    files = [f for f in os.listdir(folder) if f.lower().endswith(".py")]
-    files = [example_solution_file] + [
-        os.path.join(folder, f) for f in files if f != example_solution_file
-    ]
-    for file in tqdm(files, desc="Grading files"):
+
+def _grade_folder_file(*, folder: str, file: str, **kwargs):
+    progress.file_started()
+    try:
         curr = grade_file(
             file_to_grade=file,
-            file_with_tests=file_with_tests,
-            starting_points=starting_points,
-            quiet=quiet,
-            cleanup_first=cleanup_first,
-            cleanup_only=cleanup_only,
-            black_the_solution=black_the_solution,
-            output_file=output_file,
+            record_file=os.path.join(folder, "grading_record.jsonl"),
+            **kwargs,
         )
-        if file == example_solution_file:
-            print(f"Example solution: {curr}")
-            assert (
-                curr[1] >= 100
-            ), f"Example solution should have 100 points, but only has {curr[1]}"
-        # write to summary file, add column names if necessary
+    finally:
+        progress.file_done()
+    if curr is None:  # cleanup only
+        return curr
+    # write to summary file, add column names if necessary
+    fn_summary = os.path.join(folder, "summary.csv")
+    with locked_file(fn_summary):
         if not os.path.exists(fn_summary):
             with open(fn_summary, "w") as f_summary:
                 f_summary.write("ts,filename,submission_id,student_id,points\n")
         with open(fn_summary, "a") as f_summary:
             ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             basename = os.path.basename(file)
-            if "WorkCode" in basename:
-                submission_id = (
-                    os.path.splitext(basename)[0].split("WorkCode_")[1].split(".")[0]
-                )
-            else:
-                submission_id = "UNKNOWN_SUBMISSION_ID"
+            submission_id = submission_id_from_filename(basename)
             f_summary.write(f"{ts},{basename},{submission_id},{curr[0]},{curr[1]}\n")
+    return curr
+
+
+def cleanup_files_in_folder(
+    *,
+    folder: str,
+    example_solution_file: str = None,
+    num_processes: int = -1,
+    quiet: bool = False,
+) -> (int, int):
+    """
+    Removes the grader notes from all the submissions in a folder, in parallel. Only the files that contain
+    notes are rewritten.
+
+    Args:
+        folder: str, the folder with the submissions. Several folders can be separated by commas.
+        example_solution_file: str, an additional file to clean, unless it is one of the submissions.
+        num_processes: int, the number of worker processes. Negative values mean one per CPU.
+        quiet: bool, if True, suppress all output.
+
+    Returns:
+        int, the number of files that were changed.
+        int, the number of lines that were removed or changed.
+    """
+    files = [f for folder_ in folder.split(",") for f in submission_files(folder_)]
+    if example_solution_file is not None and os.path.abspath(
+        example_solution_file
+    ) not in map(os.path.abspath, files):
+        files.append(example_solution_file)
+    if num_processes < 0:
+        num_processes = os.cpu_count()
+    n_files = n_lines = 0
+    with ProcessPoolExecutor(max_workers=num_processes) as executor:
+        for n_changed in executor.map(
+            cleanup_grader_notes_if_present, files, chunksize=16
+        ):
+            if n_changed:
+                n_files += 1
+                n_lines += n_changed
+    if not quiet:
+        print(f"Cleaned up {n_lines} lines in {n_files} of {len(files)} files")
+    return n_files, n_lines
 
 
 def grade_files_in_folder(
@@ -180,7 +468,24 @@ def grade_files_in_folder(
     cleanup_only: bool = False,
     black_the_solution: bool = False,
     num_threads: int = -1,
+    skeleton_file: str = None,
+    results_cache_file: str = None,
+    timeout: float = None,
+    progress_port: int = None,
+    grading_spec: str = None,
+    memory_limit: int = None,
+    priority_files: str = None,
+    disable_plugin_autoload: bool = False,
 ):
+    """
+    Grades all the submissions in a folder, or in several comma-separated folders, in parallel. The files are
+    graded longest first (see scheduling.py), after the comma-separated `priority_files` (e.g. late submissions
+    or regrade requests, by file name or path). The priority lane only reorders the files of this run, the
+    entries that are not in `folder` are reported and not graded.
+
+    The progress of the run is shown in the terminal unless `quiet`, and, if `progress_port` is given, served as
+    JSON on http://127.0.0.1:<progress_port>. See `grade_file` for the other arguments.
+    """
     if "," in folder:
         folders = folder.split(",")
     else:
@@ -188,12 +493,22 @@ def grade_files_in_folder(
     if num_threads < 0:
         n_cpus = os.cpu_count()
         num_threads = max(n_cpus - num_threads, 1)
+    if cleanup_only and not black_the_solution:
+        cleanup_files_in_folder(
+            folder=folder,
+            example_solution_file=example_solution_file,
+            num_processes=num_threads,
+            quiet=quiet,
+        )
+        return
 
-    #### # override
-    if True:
-        file_to_grade = "data/submissions/group5/ID_212410104_WorkCode_533293.PY"
-        curr = grade_file(
-            file_to_grade=file_to_grade,
+    progress.reset()
+    with showing_progress(display=not quiet, port=progress_port):
+        _grade_folders(
+            folders=folders,
+            num_threads=num_threads,
+            summary_file_strategy=summary_file_strategy,
+            example_solution_file=example_solution_file,
             file_with_tests=file_with_tests,
             starting_points=starting_points,
             quiet=quiet,
@@ -201,45 +516,69 @@ def grade_files_in_folder(
             cleanup_only=cleanup_only,
             black_the_solution=black_the_solution,
             output_file=output_file,
+            skeleton_file=skeleton_file,
+            results_cache_file=results_cache_file,
+            timeout=timeout,
+            grading_spec=grading_spec,
+            memory_limit=memory_limit,
+            disable_plugin_autoload=disable_plugin_autoload,
+            priority_files=priority_files.split(",") if priority_files else None,
         )
-        print("ts,filename,submission_id,student_id,points\n")
 
-        ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        basename = os.path.basename(file_to_grade)
-        if "WorkCode" in basename:
-            submission_id = (
-                os.path.splitext(basename)[0].split("WorkCode_")[1].split(".")[0]
-            )
-        else:
-            submission_id = "UNKNOWN_SUBMISSION_ID"
-        print(f"{ts},{basename},{submission_id},{curr[0]},{curr[1]}\n")
-        print("DONE")
-        return
 
-    ####
+def _grade_folders(
+    *,
+    folders: list,
+    num_threads: int,
+    summary_file_strategy: Literal["overwrite", "append", "cancel"] = "overwrite",
+    example_solution_file: str = None,
+    priority_files: list = None,
+    **kwargs,
+):
+    example_solution_file = os.path.abspath(example_solution_file)
+    assert os.path.exists(
+        example_solution_file
+    ), f"File not found: {example_solution_file}"
+    durations = {}
+    for folder in folders:
+        durations.update(_prepare_folder(folder, summary_file_strategy))
+    folder_of = {
+        f: folder
+        for folder in folders
+        for f in submission_files(folder)
+        if os.path.abspath(f) != example_solution_file
+    }
+    progress.files_queued(len(folders) + len(folder_of))
+    kwargs["reference_file"] = example_solution_file
+
+    # the example solution validates the tests, it is graded first in every folder
+    full_points = kwargs.get("starting_points", 100)
+    if kwargs.get("grading_spec") is not None:
+        full_points = load_grading_spec(kwargs["grading_spec"]).starting_points
+    for folder in folders:
+        curr = _grade_folder_file(folder=folder, file=example_solution_file, **kwargs)
+        if curr is not None:
+            print(f"Example solution: {curr}")
+            assert (
+                curr[1] >= full_points
+            ), f"Example solution should have {full_points} points, but only has {curr[1]}"
 
+    # one pool for the files of all the folders, the priority lane first, then the longest files first
+    for name in unmatched_priority(list(folder_of), priority_files):
+        print(f"Priority file not in {', '.join(folders)}, not graded: {name}")
+    files = schedule(list(folder_of), durations=durations, priority=priority_files)
     with ThreadPoolExecutor(max_workers=num_threads) as executor:
         futures = [
-            executor.submit(
-                _grade_folder,
-                folder=folder,
-                summary_file_strategy=summary_file_strategy,
-                example_solution_file=example_solution_file,
-                file_with_tests=file_with_tests,
-                starting_points=starting_points,
-                quiet=quiet,
-                cleanup_first=cleanup_first,
-                cleanup_only=cleanup_only,
-                black_the_solution=black_the_solution,
-                output_file=output_file,
-            )
-            for folder in folders
+            executor.submit(_grade_folder_file, folder=folder_of[f], file=f, **kwargs)
+            for f in files
         ]
         for future in futures:
             future.result()  # Wait for each future to complete and handle exceptions if necessary
 
 
 if __name__ == "__main__":
+    import defopt
+
     defopt.run(
         grade_files_in_folder,
         short={
@@ -252,5 +591,12 @@ if __name__ == "__main__":
             "quiet": "q",
             "output-file": "o",
             "black-the-solution": "b",
+            "skeleton-file": "k",
+            "results-cache-file": "r",
+            "progress-port": "p",
+            "grading-spec": "g",
+            "memory-limit": "m",
+            "priority-files": "P",
+            "disable-plugin-autoload": "D",
         },
     )
@@ -0,0 +1,165 @@
+"""
+Backends used by `check_open_questions` to get grading verdicts from a language model.
+
+A backend receives the fully formatted system message and returns the raw (JSON) text of the model's answer.
+A single backend instance is shared by all grading threads, so that HTTP connections are pooled and kept alive
+across requests instead of being opened per worker.
+"""
+import json
+import os
+import re
+import threading
+
+
+class GradingBackend:
+    """Base class for grading backends."""
+
+    def complete(self, system_message: str) -> str:
+        raise NotImplementedError()
+
+
+class OpenAIBackend(GradingBackend):
+    """
+    Talks to the OpenAI API, or to any OpenAI-compatible HTTP endpoint (e.g. a local vLLM, llama.cpp or
+    Ollama server) when `base_url` is given.
+
+    Args:
+        model: str, the name of the model to use.
+        base_url: str, the URL of an OpenAI-compatible endpoint, e.g. "http://localhost:8000/v1". Defaults to the
+            OpenAI API.
+        api_key: str, the API key. Defaults to the OPENAI_API_KEY environment variable (or .env file). Local
+            endpoints usually accept any value.
+        organization: str, the OpenAI organization. Defaults to the OPENAI_ORG_ID environment variable.
+        json_mode: bool, if True, ask the endpoint to return a JSON object. Some local servers do not support it.
+        max_connections: int, the size of the shared connection pool.
+        timeout: float, the timeout of a single request, in seconds.
+    """
+
+    def __init__(
+        self,
+        *,
+        model: str = "gpt-3.5-turbo",
+        base_url: str = None,
+        api_key: str = None,
+        organization: str = None,
+        json_mode: bool = True,
+        max_connections: int = 32,
+        timeout: float = 120,
+    ):
+        import httpx
+        from dotenv import load_dotenv
+        from openai import OpenAI  # pip install openai
+
+        load_dotenv()
+        if api_key is None:
+            api_key = os.getenv("OPENAI_API_KEY", "local" if base_url else None)
+        if organization is None:
+            organization = os.getenv("OPENAI_ORG_ID", None)
+        self.model = model
+        self.json_mode = json_mode
+        # one pooled, keep-alive HTTP client for all the grading threads
+        http_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            timeout=timeout,
+        )
+        self.client = OpenAI(
+            api_key=api_key,
+            organization=organization,
+            base_url=base_url,
+            http_client=http_client,
+        )
+
+    def complete(self, system_message: str) -> str:
+        kwargs = {}
+        if self.json_mode:
+            kwargs["response_format"] = {"type": "json_object"}
+        chat_completion = self.client.chat.completions.create(
+            messages=[
+                {"role": "system", "content": system_message},
+            ],
+            model=self.model,
+            **kwargs,
+        )
+        return chat_completion.choices[0].message.content
+
+
+class StubBackend(GradingBackend):
+    """
+    Deterministic in-process backend for tests (see test_check_open_questions.py). Every response gets
+    `verdict`, except empty responses which are graded as "empty". Batched requests get one verdict per
+    response.
+
+    Args:
+        verdict: dict, the verdict to return. Defaults to a perfect grade.
+    """
+
+    perfect_verdict = {
+        "valid": "valid",
+        "gross mistakes": "absent",
+        "gross mistakes explanation": "absent",
+        "accuracy": "accurate",
+        "accuracy explanation": "accurate",
+        "completeness": "complete",
+        "completeness explanation": "complete",
+        "relevance": "relevant",
+        "relevance explanation": "relevant",
+        "overall quality": "good",
+    }
+
+    def __init__(self, verdict: dict = None):
+        self.verdict = dict(self.perfect_verdict if verdict is None else verdict)
+        self.n_calls = 0
+        self._lock = threading.Lock()
+
+    def _verdict_for(self, response: str) -> dict:
+        if not response.strip():
+            return dict(self.verdict, valid="empty")
+        return dict(self.verdict)
+
+    def complete(self, system_message: str) -> str:
+        with self._lock:
+            self.n_calls += 1
+        batched = re.findall(
+            r'<response id="(\d+)">\n(.*?)\n</response>', system_message, re.DOTALL
+        )
+        if batched:
+            verdicts = [
+                dict(self._verdict_for(response), id=int(response_id))
+                for response_id, response in batched
+            ]
+            return json.dumps({"verdicts": verdicts})
+        match = re.search(r"<response>\n(.*?)\n</response>", system_message, re.DOTALL)
+        return json.dumps(self._verdict_for(match.group(1) if match else ""))
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def set_grading_backend(backend: GradingBackend) -> None:
+    """Sets the backend shared by all the grading threads."""
+    global _backend
+    with _backend_lock:
+        _backend = backend
+
+
+def get_grading_backend() -> GradingBackend:
+    """
+    Returns the shared grading backend. Unless set with `set_grading_backend`, an `OpenAIBackend` is created on
+    first use, configured by the GRADER_LLM_BASE_URL and GRADER_LLM_MODEL environment variables.
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            from dotenv import load_dotenv
+
+            # the settings may come from the .env file, as the API key does
+            load_dotenv()
+            _backend = OpenAIBackend(
+                model=os.getenv("GRADER_LLM_MODEL", "gpt-3.5-turbo"),
+                base_url=os.getenv("GRADER_LLM_BASE_URL", None),
+            )
+        return _backend
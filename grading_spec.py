@@ -0,0 +1,71 @@
+"""
+Declarative grading specs, replacing the per-test `points = ...` / `function = solution.X` / try-except
+boilerplate. A spec is a TOML (or YAML) file:
+
+    starting_points = 100
+    score_floor = 0  # the lowest total, once the score drops to it the remaining tests are skipped
+
+    [tests.test_modulus]
+    points = 20
+    function = "modulus"  # the function the grader notes are written into
+    timeout = 5  # seconds
+    cost = 1  # relative cost, expensive tests run last
+    depends_on = ["test_other"]  # in addition to the dependencies inferred by prefilter.test_dependencies
+
+The conftest plugin loads the spec given with --grading-spec, and deducts the points of the failing tests
+through pytest hooks, so that the tests themselves are plain pytest tests.
+"""
+import os
+from dataclasses import dataclass, field
+from functools import lru_cache
+
+
+@dataclass
+class GradedTestSpec:
+    points: float
+    function: str = None
+    timeout: float = None
+    cost: float = 1
+    depends_on: list = None
+
+
+@dataclass
+class GradingSpec:
+    starting_points: float = 100
+    score_floor: float = None
+    tests: dict = field(default_factory=dict)  # test name -> GradedTestSpec
+
+
+@lru_cache(maxsize=None)
+def load_grading_spec(fn: str) -> GradingSpec:
+    """Loads a grading spec from a .toml, .yaml or .yml file."""
+    ext = os.path.splitext(fn)[1].lower()
+    if ext == ".toml":
+        try:
+            import tomllib
+        except ImportError:  # python < 3.11
+            import tomli as tomllib
+
+        with open(fn, "rb") as file:
+            data = tomllib.load(file)
+    elif ext in {".yaml", ".yml"}:
+        import yaml  # pip install pyyaml
+
+        with open(fn, "r") as file:
+            data = yaml.safe_load(file) or {}
+    else:
+        raise ValueError(f"Unsupported grading spec format: {fn}")
+
+    tests = {}
+    for test_name, test in (data.get("tests") or {}).items():
+        if "points" not in test:
+            raise ValueError(f"{fn}: test {test_name} has no points")
+        unknown = set(test) - {"points", "function", "timeout", "cost", "depends_on"}
+        if unknown:
+            raise ValueError(f"{fn}: unknown keys for test {test_name}: {unknown}")
+        tests[test_name] = GradedTestSpec(**test)
+    return GradingSpec(
+        starting_points=data.get("starting_points", 100),
+        score_floor=data.get("score_floor", None),
+        tests=tests,
+    )
@@ -0,0 +1,197 @@
+"""
+Exports a graded folder in the bulk-upload formats of learning management systems:
+
+  - grades.csv, one row per submission: the points of the code and the grade of every open question.
+  - feedback/<submission_id>.zip, one archive per submission: the annotated .py file and a feedback.txt
+    with the grader notes and the feedback on the open questions.
+
+The points are read from the summary.csv written by `grade.py`, the open-question feedback from the jsonl
+file written by `check_open_questions.save_open_question_feedback`. The submissions are streamed from disk
+and zipped in parallel worker processes, so memory use does not grow with the size of the cohort.
+
+Usage:
+
+  python lms_export.py -f data/submissions/group5 -j data/open_questions_group5.jsonl
+"""
+import csv
+import json
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from assignment_updater import GRADER_TOKEN
+
+
+def latest_summary_rows(summary_file: str) -> dict:
+    """Maps every file in a summary.csv to its row. Grading runs may append to the summary, the last row wins."""
+    rows = {}
+    with open(summary_file, "r", newline="") as file:
+        for row in csv.DictReader(file):
+            rows[row["filename"]] = row
+    return rows
+
+
+def _submission_key(row: dict) -> str:
+    # the name of the archive of the submission, and the id of its open-question feedback
+    if row["submission_id"] == "UNKNOWN_SUBMISSION_ID":
+        return os.path.splitext(row["filename"])[0]
+    return row["submission_id"]
+
+
+def index_open_questions(open_questions_file: str) -> (dict, list):
+    """
+    Indexes the jsonl file of open-question feedback without keeping its content in memory.
+
+    Returns:
+        dict, mapping every submission id to the offsets of its lines in the file.
+        list, the questions, in order of appearance.
+    """
+    offsets = {}
+    questions = {}
+    with open(open_questions_file, "rb") as file:
+        offset = 0
+        for line in file:
+            if line.strip():
+                entry = json.loads(line)
+                offsets.setdefault(str(entry["submission_id"]), []).append(offset)
+                questions.setdefault(entry["question"], None)
+            offset += len(line)
+    return offsets, list(questions)
+
+
+def _read_open_questions(open_questions_file: str, offsets: list) -> list:
+    ret = []
+    with open(open_questions_file, "rb") as file:
+        for offset in offsets:
+            file.seek(offset)
+            ret.append(json.loads(file.readline()))
+    return ret
+
+
+def feedback_text(row: dict, file_to_grade: str, open_questions: list) -> str:
+    """The feedback.txt of a submission: its points, the grader notes and the open-question feedback."""
+    parts = [f"Submission: {_submission_key(row)}", f"Points: {row['points']}", ""]
+    parts.append("Grader notes:")
+    with open(file_to_grade, "r", errors="replace") as file:
+        notes = [line.strip() for line in file if GRADER_TOKEN in line]
+    parts.extend(notes or ["(none)"])
+    for entry in open_questions:
+        parts += ["", f"Question: {entry['question']}", f"Grade: {entry.get('grade')}"]
+        for key in ["feedback", "more details", "correct_answer"]:
+            if entry.get(key):
+                parts += [f"{key.capitalize()}:", str(entry[key]).strip()]
+    return "\n".join(parts) + "\n"
+
+
+def _export_submission(args) -> dict:
+    (
+        row,
+        file_to_grade,
+        zip_file,
+        open_questions_file,
+        offsets,
+        compression_level,
+    ) = args
+    open_questions = []
+    if offsets:
+        open_questions = _read_open_questions(open_questions_file, offsets)
+    tmp_file = zip_file + ".tmp"
+    with zipfile.ZipFile(
+        tmp_file,
+        "w",
+        compression=zipfile.ZIP_DEFLATED,
+        compresslevel=compression_level,
+    ) as archive:
+        archive.write(file_to_grade, arcname=os.path.basename(file_to_grade))
+        archive.writestr(
+            "feedback.txt", feedback_text(row, file_to_grade, open_questions)
+        )
+    os.replace(tmp_file, zip_file)
+    return {entry["question"]: entry.get("grade") for entry in open_questions}
+
+
+def export_to_lms(
+    *,
+    folder: str,
+    output_folder: str = None,
+    open_questions_file: str = None,
+    num_processes: int = -1,
+    compression_level: int = 6,
+    quiet: bool = False,
+) -> str:
+    """
+    Writes grades.csv and the per-submission feedback archives of a graded folder.
+
+    Args:
+        folder: str, the graded folder, with its summary.csv.
+        output_folder: str, the folder to write to. Defaults to lms_export in `folder`.
+        open_questions_file: str, a jsonl file with the open-question feedback to merge in (see
+        `check_open_questions.save_open_question_feedback`).
+        num_processes: int, the number of worker processes. Negative values mean one per CPU.
+        compression_level: int, the zlib compression level of the archives, from 0 to 9.
+        quiet: bool, if True, suppress all output.
+
+    Returns:
+        str, the path of grades.csv.
+    """
+    if output_folder is None:
+        output_folder = os.path.join(folder, "lms_export")
+    feedback_folder = os.path.join(output_folder, "feedback")
+    os.makedirs(feedback_folder, exist_ok=True)
+    if num_processes < 0:
+        num_processes = os.cpu_count()
+    offsets, questions = {}, []
+    if open_questions_file is not None:
+        offsets, questions = index_open_questions(open_questions_file)
+
+    # the example solution is graded along with the folder, but is not one of its files
+    rows = [
+        row
+        for row in latest_summary_rows(os.path.join(folder, "summary.csv")).values()
+        if os.path.exists(os.path.join(folder, row["filename"]))
+    ]
+    tasks = (
+        (
+            row,
+            os.path.join(folder, row["filename"]),
+            os.path.join(feedback_folder, f"{_submission_key(row)}.zip"),
+            open_questions_file,
+            offsets.get(_submission_key(row), []),
+            compression_level,
+        )
+        for row in rows
+    )
+    grades_file = os.path.join(output_folder, "grades.csv")
+    with open(grades_file, "w", newline="") as file, ProcessPoolExecutor(
+        max_workers=num_processes
+    ) as executor:
+        writer = csv.writer(file)
+        writer.writerow(["submission_id", "student_id", "points", *questions])
+        for row, grades in zip(
+            rows, executor.map(_export_submission, tasks, chunksize=16)
+        ):
+            writer.writerow(
+                [
+                    _submission_key(row),
+                    row["student_id"],
+                    row["points"],
+                    *[grades.get(question, "") for question in questions],
+                ]
+            )
+    if not quiet:
+        print(f"Exported {len(rows)} submissions to {output_folder}")
+    return grades_file
+
+
+if __name__ == "__main__":
+    import defopt
+
+    defopt.run(
+        export_to_lms,
+        short={
+            "folder": "f",
+            "output-folder": "o",
+            "open-questions-file": "j",
+            "quiet": "q",
+        },
+    )
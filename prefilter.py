@@ -0,0 +1,289 @@
+"""
+Static pre-stage of grading: parses a submission once with `ast`, without importing or running it, and finds
+out which tests can not possibly pass, so that pytest only runs the tests that can.
+
+Tests are mapped to the function they grade through the `points = ...` and `function = solution.X`
+assignments that open every test (see `sample_tests.py`). A tested function is unimplemented when all it does is
+raise NotImplementedError, or when it is identical to its skeleton version and that version is a stub (only
+`pass`, a docstring or `...`). Functions the skeleton ships working are graded as usual.
+
+The same parse of the test file yields the dependencies between the tests, used by the conftest plugin to
+run the tests that depend on a broken function against the reference implementation of that function.
+"""
+
+import ast
+from dataclasses import dataclass, field
+from functools import lru_cache
+
+from grading_spec import load_grading_spec
+
+
+@dataclass
+class GradedTest:
+    name: str  # the name of the test function
+    target: str  # the qualified name of the tested function, e.g. "Point.__init__"
+    points: float  # the points deducted when the test fails
+
+
+@dataclass
+class PrefilterResult:
+    syntax_error: str = None
+    # GradedTest's whose function has no def in the file (it may be inherited, imported or assigned)
+    missing: list = field(default_factory=list)
+    unimplemented: list = field(default_factory=list)  # GradedTest's that can't pass
+    # names of the tests pytest should run
+    tests_to_run: list = field(default_factory=list)
+
+
+def _dotted_name(node) -> str:
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        prefix = _dotted_name(node.value)
+        if prefix is not None:
+            return f"{prefix}.{node.attr}"
+    return None
+
+
+@lru_cache(maxsize=None)
+def graded_tests(file_with_tests: str, grading_spec: str = None) -> dict:
+    """
+    Returns a dict mapping the name of every test in `file_with_tests` to its GradedTest, or to None if the
+    test does not declare the function it grades. The tests listed in the `grading_spec` file take their
+    points and function from there.
+    """
+    spec_tests = load_grading_spec(grading_spec).tests if grading_spec else {}
+    with open(file_with_tests, "r") as file:
+        tree = ast.parse(file.read())
+    ret = {}
+    for node in tree.body:
+        if not isinstance(node, ast.FunctionDef) or not node.name.startswith("test"):
+            continue
+        test_spec = spec_tests.get(node.name)
+        if test_spec is not None:
+            ret[node.name] = None
+            if test_spec.function is not None:
+                ret[node.name] = GradedTest(
+                    name=node.name, target=test_spec.function, points=test_spec.points
+                )
+            continue
+        target = points = None
+        for statement in node.body:
+            if not isinstance(statement, ast.Assign) or len(statement.targets) != 1:
+                continue
+            variable = _dotted_name(statement.targets[0])
+            if variable == "points" and isinstance(statement.value, ast.Constant):
+                points = statement.value.value
+            elif variable == "function":
+                value = _dotted_name(statement.value)
+                if value is not None and value.startswith("solution."):
+                    target = value[len("solution.") :]
+        if target is not None and isinstance(points, (int, float)):
+            ret[node.name] = GradedTest(name=node.name, target=target, points=points)
+        else:
+            ret[node.name] = None
+    return ret
+
+
+def _solution_names(node) -> set:
+    """
+    The `solution.X` attributes used in `node`. Calling a class also uses its constructor, e.g.
+    `solution.Point(3, 4)` uses {"Point", "Point.__init__"}.
+    """
+    ret = set()
+    for child in ast.walk(node):
+        if isinstance(child, ast.Attribute):
+            name = _dotted_name(child)
+            if name is not None and name.startswith("solution."):
+                ret.add(name[len("solution.") :])
+        elif isinstance(child, ast.Call):
+            name = _dotted_name(child.func)
+            if name is not None and name.startswith("solution."):
+                ret.add(name[len("solution.") :] + ".__init__")
+    return ret
+
+
+def _is_fixture(node) -> bool:
+    for decorator in node.decorator_list:
+        if isinstance(decorator, ast.Call):
+            decorator = decorator.func
+        if _dotted_name(decorator) in {"pytest.fixture", "fixture"}:
+            return True
+    return False
+
+
+@lru_cache(maxsize=None)
+def used_solution_names(file_with_tests: str) -> dict:
+    """
+    Returns a dict mapping the name of every test in `file_with_tests` to the `solution.X` names it uses,
+    directly or through the fixtures of the test file (see `_solution_names`).
+    """
+    with open(file_with_tests, "r") as file:
+        tree = ast.parse(file.read())
+    functions = {
+        node.name: node for node in tree.body if isinstance(node, ast.FunctionDef)
+    }
+
+    def used_names(node, seen):
+        ret = _solution_names(node)
+        for arg in node.args.args:
+            fixture = functions.get(arg.arg)
+            if fixture is not None and _is_fixture(fixture) and arg.arg not in seen:
+                seen.add(arg.arg)
+                ret |= used_names(fixture, seen)
+        return ret
+
+    return {
+        name: used_names(node, {name})
+        for name, node in functions.items()
+        if name.startswith("test")
+    }
+
+
+@lru_cache(maxsize=None)
+def test_dependencies(file_with_tests: str, grading_spec: str = None) -> dict:
+    """
+    Returns a dict mapping the name of every test in `file_with_tests` to the set of tests it depends on: the
+    tests listed in its `depends_on` in the `grading_spec`, and the tests whose target function it uses,
+    directly or through the fixtures of the test file. E.g. a test using a `Point` built by a fixture depends
+    on the tests of `Point.__init__`.
+    """
+    targets = graded_tests(file_with_tests, grading_spec)
+    spec_tests = load_grading_spec(grading_spec).tests if grading_spec else {}
+    solution_names = used_solution_names(file_with_tests)
+    inferred = {}
+    for test_name, graded_test in targets.items():
+        names = solution_names[test_name]
+        inferred[test_name] = {
+            other.name
+            for other in targets.values()
+            if other is not None
+            and other.target in names
+            and (graded_test is None or other.target != graded_test.target)
+        }
+    ret = {}
+    for test_name, prerequisites in inferred.items():
+        # tests using each other's target are unordered
+        ret[test_name] = {
+            other for other in prerequisites if test_name not in inferred[other]
+        }
+        test_spec = spec_tests.get(test_name)
+        if test_spec is not None and test_spec.depends_on:
+            ret[test_name] |= set(test_spec.depends_on)
+    return ret
+
+
+def function_nodes(tree) -> dict:
+    """Returns a dict mapping qualified names ("f", "Class.method") to the function nodes of a module."""
+    ret = {}
+
+    def visit(node, prefix):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                ret.setdefault(prefix + child.name, child)
+            elif isinstance(child, ast.ClassDef):
+                visit(child, prefix + child.name + ".")
+
+    visit(tree, "")
+    return ret
+
+
+def function_dump(node) -> str:
+    """A representation of a function node that ignores formatting, comments and docstrings."""
+    body = node.body
+    if (
+        body
+        and isinstance(body[0], ast.Expr)
+        and isinstance(body[0].value, ast.Constant)
+        and isinstance(body[0].value.value, str)
+    ):
+        body = body[1:]
+    return ast.dump(ast.Module(body=body, type_ignores=[])) + ast.dump(node.args)
+
+
+@lru_cache(maxsize=None)
+def skeleton_dumps(skeleton_file: str) -> dict:
+    """The dumps of the stub functions of the skeleton, by qualified name (see `_is_stub`)."""
+    with open(skeleton_file, "r") as file:
+        tree = ast.parse(file.read())
+    return {
+        name: function_dump(node)
+        for name, node in function_nodes(tree).items()
+        if _is_stub(node)
+    }
+
+
+def _is_stub(node) -> bool:
+    # a body of `pass`, docstrings and `...` only, or one that raises NotImplementedError
+    return _raises_not_implemented(node) or all(
+        isinstance(statement, ast.Pass)
+        or (
+            isinstance(statement, ast.Expr)
+            and isinstance(statement.value, ast.Constant)
+        )
+        for statement in node.body
+    )
+
+
+def _raises_not_implemented(node) -> bool:
+    for statement in node.body:
+        if isinstance(statement, ast.Pass) or (
+            isinstance(statement, ast.Expr)
+            and isinstance(statement.value, ast.Constant)
+        ):
+            continue
+        if isinstance(statement, ast.Raise) and statement.exc is not None:
+            exc = statement.exc
+            if isinstance(exc, ast.Call):
+                exc = exc.func
+            return _dotted_name(exc) == "NotImplementedError"
+        return False
+    return False
+
+
+def prefilter_submission(
+    file_to_grade: str,
+    file_with_tests: str,
+    skeleton_file: str = None,
+    grading_spec: str = None,
+) -> PrefilterResult:
+    """
+    Statically checks a submission against the tests.
+
+    Args:
+        file_to_grade: str, the submission.
+        file_with_tests: str, the test file.
+        skeleton_file: str, the skeleton handed to the students. If None, only functions that raise
+        NotImplementedError are considered unimplemented. Otherwise, so are the functions left as the stubs of
+        the skeleton.
+        grading_spec: str, the grading spec of the tests, if any.
+
+    Returns:
+        PrefilterResult, with the tests that can not pass and the names of the tests left to run.
+    """
+    ret = PrefilterResult()
+    targets = graded_tests(file_with_tests, grading_spec)
+    try:
+        with open(file_to_grade, "r") as file:
+            tree = ast.parse(file.read())
+    except (SyntaxError, ValueError, UnicodeDecodeError) as err:
+        ret.syntax_error = str(err)
+        return ret
+    functions = function_nodes(tree)
+    skeleton = skeleton_dumps(skeleton_file) if skeleton_file else {}
+    for test_name, graded_test in targets.items():
+        if graded_test is None:
+            ret.tests_to_run.append(test_name)
+            continue
+        node = functions.get(graded_test.target)
+        if node is None:
+            # e.g. a method inherited from a base class, let pytest decide
+            ret.missing.append(graded_test)
+            ret.tests_to_run.append(test_name)
+        elif _raises_not_implemented(node) or (
+            skeleton.get(graded_test.target) == function_dump(node)
+        ):
+            ret.unimplemented.append(graded_test)
+        else:
+            ret.tests_to_run.append(test_name)
+    return ret
@@ -0,0 +1,244 @@
+"""
+Progress and throughput metrics of a grading run, shared by all the grading threads.
+
+The counters are updated by `grade.py` (files), `check_open_questions.py` (language model calls) and
+`results_cache.py` (cache lookups). They can be rendered as a status line in the terminal and served as JSON
+over HTTP, to watch a long run from another shell:
+
+  curl http://localhost:8765
+
+`showing_progress` does both for the duration of a run, e.g. `grade.grade_files_in_folder` or
+`check_open_questions.grade_student_responses`.
+"""
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class GradingProgress:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.start_time = None
+            self.queued = 0
+            self.running = 0
+            self.done = 0
+            self.timeouts = 0
+            self.crashes = 0
+            self.llm_in_flight = 0
+            self.llm_calls = 0
+            self.llm_errors = 0
+            self.cache_hits = {}
+            self.cache_misses = {}
+
+    def files_queued(self, n: int):
+        with self._lock:
+            self.queued += n
+
+    def file_started(self):
+        with self._lock:
+            if self.start_time is None:
+                self.start_time = time.monotonic()
+            self.queued -= 1
+            self.running += 1
+
+    def file_done(self):
+        with self._lock:
+            self.running -= 1
+            self.done += 1
+
+    def timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def crash(self):
+        with self._lock:
+            self.crashes += 1
+
+    @contextmanager
+    def llm_call(self):
+        with self._lock:
+            self.llm_in_flight += 1
+        try:
+            yield
+        except Exception:
+            with self._lock:
+                self.llm_errors += 1
+            raise
+        finally:
+            with self._lock:
+                self.llm_in_flight -= 1
+                self.llm_calls += 1
+
+    def cache_lookup(self, cache: str, hit: bool):
+        with self._lock:
+            counts = self.cache_hits if hit else self.cache_misses
+            counts[cache] = counts.get(cache, 0) + 1
+
+    def snapshot(self) -> dict:
+        """Returns the current counters, the throughput and the estimated time to completion."""
+        with self._lock:
+            elapsed = 0.0
+            if self.start_time is not None:
+                elapsed = time.monotonic() - self.start_time
+            rate = self.done / elapsed if elapsed > 0 else 0.0
+            remaining = self.queued + self.running
+            caches = sorted(set(self.cache_hits) | set(self.cache_misses))
+            cache_hit_rates = {}
+            for cache in caches:
+                hits = self.cache_hits.get(cache, 0)
+                total = hits + self.cache_misses.get(cache, 0)
+                cache_hit_rates[cache] = hits / total
+            return {
+                "files_queued": self.queued,
+                "files_running": self.running,
+                "files_done": self.done,
+                "elapsed_seconds": round(elapsed, 1),
+                "files_per_second": round(rate, 3),
+                "eta_seconds": round(remaining / rate, 1) if rate else None,
+                "timeouts": self.timeouts,
+                "crashes": self.crashes,
+                "llm_in_flight": self.llm_in_flight,
+                "llm_calls": self.llm_calls,
+                "llm_errors": self.llm_errors,
+                "cache_hit_rates": cache_hit_rates,
+            }
+
+
+# The progress of the current run
+progress = GradingProgress()
+
+
+def format_snapshot(snapshot: dict) -> str:
+    total = (
+        snapshot["files_done"] + snapshot["files_running"] + snapshot["files_queued"]
+    )
+    eta = snapshot["eta_seconds"]
+    eta = "?" if eta is None else f"{int(eta) // 60}m{int(eta) % 60:02d}s"
+    llm_used = snapshot["llm_calls"] or snapshot["llm_in_flight"]
+    parts = []
+    if total or not llm_used:
+        parts += [
+            f"files {snapshot['files_done']}/{total} done, {snapshot['files_running']} running",
+            f"{snapshot['files_per_second']:.2f} files/s, ETA {eta}",
+            f"timeouts {snapshot['timeouts']}, crashes {snapshot['crashes']}",
+        ]
+    if llm_used:
+        parts.append(
+            f"LLM {snapshot['llm_in_flight']} in flight, {snapshot['llm_calls']} calls,"
+            f" {snapshot['llm_errors']} errors"
+        )
+    for cache, rate in snapshot["cache_hit_rates"].items():
+        parts.append(f"{cache} cache hits {rate:.0%}")
+    return " | ".join(parts)
+
+
+class _ClearingStream:
+    """Wraps sys.stdout or sys.stderr, to clear the status line before anything else is printed."""
+
+    def __init__(self, stream, display):
+        self._stream = stream
+        self._display = display
+
+    def write(self, s):
+        with self._display.lock:
+            self._display.clear()
+            if s:
+                # print writes the text and the newline separately, do not render in between
+                self._display.at_line_start = s.endswith("\n")
+            return self._stream.write(s)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class _TerminalDisplay:
+    def __init__(self, interval: float, stream):
+        self.interval = interval
+        self.stream = stream
+        self.lock = threading.RLock()
+        self._shown = False
+        self.at_line_start = True
+        self._stop = threading.Event()
+        # the other output starts on a clean line, the status line is rendered again after it
+        self._stdout, self._stderr = sys.stdout, sys.stderr
+        sys.stdout = _ClearingStream(sys.stdout, self)
+        sys.stderr = _ClearingStream(sys.stderr, self)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def clear(self):
+        with self.lock:
+            if self._shown:
+                self.stream.write("\r\033[K")
+                self.stream.flush()
+                self._shown = False
+
+    def _render(self):
+        with self.lock:
+            if not self.at_line_start:
+                return
+            self._stdout.flush()
+            self.stream.write("\r\033[K" + format_snapshot(progress.snapshot()))
+            self.stream.flush()
+            self._shown = True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._render()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        sys.stdout, sys.stderr = self._stdout, self._stderr
+        self._render()
+        self.stream.write("\n")
+
+
+def start_terminal_display(interval: float = 1.0, stream=None) -> _TerminalDisplay:
+    """Renders the progress as a status line every `interval` seconds, until `.stop()` is called."""
+    return _TerminalDisplay(interval, sys.stderr if stream is None else stream)
+
+
+class _ProgressRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps(progress.snapshot()).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serves the progress as JSON on http://host:port, until `.shutdown()` is called."""
+    server = ThreadingHTTPServer((host, port), _ProgressRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@contextmanager
+def showing_progress(*, display: bool = True, port: int = None):
+    """
+    Shows the progress as a status line in the terminal if `display`, and serves it as JSON on
+    http://127.0.0.1:<port> if `port` is given, for the duration of the context.
+    """
+    terminal = start_terminal_display() if display else None
+    server = start_http_server(port) if port else None
+    try:
+        yield
+    finally:
+        if terminal is not None:
+            terminal.stop()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
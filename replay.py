@@ -0,0 +1,150 @@
+"""
+Offline replay of the grading of a folder, to see whose grades a change of the scoring would change.
+
+The points of the code are recomputed from the grader notes of the annotated files with
+`assignment_updater.sum_up_grader_points`, using the starting points, the score floor and how the run ended from
+the grading_record.jsonl written by `grade.py`. Files whose notes were cleaned up since are recomputed from the
+points of the notes stored in the record. The grades of the open questions are recomputed from the raw verdicts
+stored by `check_open_questions`, with `regrade_from_verdicts`. Neither pytest nor the model is run. The new
+grades are compared with summary.csv and with the stored grades.
+
+A change of the points of a test, in the tests or in the grading spec, changes the notes themselves and only
+shows after grading the folder again.
+
+Usage:
+
+  python replay.py -f data/submissions/group5 -j data/open_questions_group5.jsonl
+"""
+import csv
+import json
+import os
+
+from assignment_updater import GRADER_TOKEN, sum_up_grader_points, total_points
+from check_open_questions import regrade_from_verdicts
+from grade import submission_id_from_filename
+from lms_export import latest_summary_rows
+
+
+def replay_code_points(record: dict, file_to_grade: str = None) -> int:
+    """
+    The points of a graded file, recomputed from the grader notes in `file_to_grade` if it still has them,
+    otherwise from the points of the notes stored in its grading record. The per-test deductions of the record
+    are not used, they miss the notes that did not come from pytest (cached results, unimplemented functions).
+    """
+    if record["status"] != "ok":
+        # the tests could not run to completion, see grade.grade_file
+        return 0
+    if file_to_grade is not None and os.path.exists(file_to_grade):
+        with open(file_to_grade, "r") as file:
+            annotated = GRADER_TOKEN in file.read()
+        if annotated or not record["grader_points"]:
+            return sum_up_grader_points(
+                file_to_grade,
+                starting_points=record["starting_points"],
+                quiet=True,
+                score_floor=record.get("score_floor"),
+            )[1]
+    return total_points(
+        record["starting_points"], record["grader_points"], record.get("score_floor")
+    )
+
+
+def _latest_records(record_file: str) -> dict:
+    records = {}
+    with open(record_file, "r") as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                records[record["filename"]] = record
+    return records
+
+
+def replay_folder(
+    *,
+    folder: str,
+    open_questions_file: str = None,
+    output_file: str = None,
+    quiet: bool = False,
+) -> list:
+    """
+    Recomputes the grades of a graded folder offline and reports the ones that changed.
+
+    Args:
+        folder: str, the graded folder, with its summary.csv and grading_record.jsonl.
+        open_questions_file: str, a jsonl file with the open-question grades to recompute (see
+        `check_open_questions.save_open_question_feedback`).
+        output_file: str, a csv file to write the changed grades to. Defaults to replay.csv in `folder`.
+        quiet: bool, if True, suppress all output.
+
+    Returns:
+        list, the changed grades, as dicts with the filename (or the question), the submission id, and the old
+        and the new grade.
+    """
+    summary = latest_summary_rows(os.path.join(folder, "summary.csv"))
+    records = _latest_records(os.path.join(folder, "grading_record.jsonl"))
+    changes = []
+    n_grades = 0
+    for filename, record in records.items():
+        row = summary.get(filename)
+        old = row["points"] if row is not None else None
+        new = replay_code_points(record, os.path.join(folder, filename))
+        n_grades += 1
+        if old is None or float(old) != new:
+            changes.append(
+                {
+                    "item": filename,
+                    "submission_id": submission_id_from_filename(filename),
+                    "old": old,
+                    "new": new,
+                }
+            )
+    if open_questions_file is not None:
+        with open(open_questions_file, "r") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if "replay" not in entry:
+                    continue  # graded before the verdicts were stored
+                new = regrade_from_verdicts(entry)["grade"]
+                n_grades += 1
+                if entry["grade"] != new:
+                    changes.append(
+                        {
+                            "item": entry["question"],
+                            "submission_id": entry["submission_id"],
+                            "old": entry["grade"],
+                            "new": new,
+                        }
+                    )
+
+    if output_file is None:
+        output_file = os.path.join(folder, "replay.csv")
+    with open(output_file, "w", newline="") as file:
+        writer = csv.DictWriter(
+            file, fieldnames=["item", "submission_id", "old", "new"]
+        )
+        writer.writeheader()
+        writer.writerows(changes)
+    if not quiet:
+        for change in changes:
+            print(
+                f"{change['item']:<40s} {change['submission_id']:<20s} "
+                f"{change['old']} -> {change['new']}"
+            )
+        print(f"{len(changes)} of {n_grades} grades would change")
+    return changes
+
+
+if __name__ == "__main__":
+    import defopt
+
+    defopt.run(
+        replay_folder,
+        short={
+            "folder": "f",
+            "open-questions-file": "j",
+            "output-file": "o",
+            "quiet": "q",
+        },
+    )
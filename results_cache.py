@@ -0,0 +1,204 @@
+"""
+Cache of test results keyed by the AST of the functions each test uses.
+
+A test whose target function (see `prefilter.graded_tests`) and the other `solution.X` functions it uses, directly
+or through fixtures (see `prefilter.used_solution_names`), are identical, up to formatting and comments, to
+versions that were already graded together gets the cached result instead of being run again. Using a class uses
+all its methods. This relies on tests grading their target in isolation, using the solution for the functions
+their target calls, as the README recommends.
+
+The cache is a jsonl file, one line per (test file, test, function) result, so that it survives across runs and
+can be shared by several cohorts graded with the same tests.
+"""
+
+import ast
+import hashlib
+import json
+import os
+import threading
+
+from assignment_updater import annotate_file, annotate_function
+from prefilter import (
+    function_dump,
+    function_nodes,
+    graded_tests,
+    used_solution_names,
+)
+from progress import progress
+
+
+def function_hash(node) -> str:
+    """Hash of a function node, ignoring formatting, comments and docstrings."""
+    return hashlib.sha1(function_dump(node).encode("utf-8")).hexdigest()
+
+
+def functions_hash(functions: dict, target: str, names: set) -> str:
+    """
+    Hash of the function `target` and of the functions `names` refer to, ignoring formatting, comments and
+    docstrings. A name refers to the function of that name, or to the methods of the class of that name.
+    """
+    used = {
+        qualified_name
+        for qualified_name in functions
+        for name in names | {target}
+        if qualified_name == name or qualified_name.startswith(name + ".")
+    }
+    hashes = [f"{name}:{function_hash(functions[name])}" for name in sorted(used)]
+    return hashlib.sha1("\n".join(hashes).encode("utf-8")).hexdigest()
+
+
+def file_hash(fn: str) -> str:
+    with open(fn, "rb") as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+def _tests_hash(file_with_tests: str, grading_spec: str = None) -> str:
+    # the results depend on the points and timeouts in the grading spec as much as on the tests
+    if grading_spec is None:
+        return file_hash(file_with_tests)
+    return file_hash(file_with_tests) + file_hash(grading_spec)
+
+
+class ResultsCache:
+    """
+    Args:
+        cache_file: str, the jsonl file the results are loaded from and appended to.
+    """
+
+    def __init__(self, cache_file: str):
+        self.cache_file = cache_file
+        self._lock = threading.Lock()
+        self._results = {}
+        if os.path.exists(cache_file):
+            with open(cache_file, "r") as file:
+                for line in file:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    key = (entry["tests_hash"], entry["test"], entry["function_hash"])
+                    self._results[key] = entry["result"]
+
+    def get(self, tests_hash: str, test_name: str, function_hash: str) -> dict:
+        """Returns the cached result, a dict with the outcome and the deductions of the test, or None."""
+        with self._lock:
+            return self._results.get((tests_hash, test_name, function_hash))
+
+    def put(self, tests_hash: str, test_name: str, function_hash: str, result: dict):
+        key = (tests_hash, test_name, function_hash)
+        with self._lock:
+            if key in self._results:
+                return
+            self._results[key] = result
+            with open(self.cache_file, "a") as file:
+                entry = {
+                    "tests_hash": tests_hash,
+                    "test": test_name,
+                    "function_hash": function_hash,
+                    "result": result,
+                }
+                file.write(json.dumps(entry) + "\n")
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_results_cache(cache_file: str) -> ResultsCache:
+    """Returns the ResultsCache of `cache_file`, shared by all the grading threads."""
+    cache_file = os.path.abspath(cache_file)
+    with _caches_lock:
+        if cache_file not in _caches:
+            _caches[cache_file] = ResultsCache(cache_file)
+        return _caches[cache_file]
+
+
+def apply_cached_results(
+    file_to_grade: str,
+    file_with_tests: str,
+    test_names: list,
+    cache: ResultsCache,
+    grading_spec: str = None,
+) -> (list, dict, list):
+    """
+    Writes the cached deductions of every test in `test_names` whose target function, and the functions it
+    uses, were already graded into `file_to_grade`.
+
+    Args:
+        file_to_grade: str, the submission.
+        file_with_tests: str, the test file.
+        test_names: list, the names of the tests to consider, or None for all the tests in `file_with_tests`.
+        cache: ResultsCache, the cache to look the results up in.
+        grading_spec: str, the grading spec of the tests, if any.
+
+    Returns:
+        list, the names of the tests that still have to run (None, as in the input, when nothing was cached).
+        dict, mapping the tests that have to run and have a target function to the hash of the functions they
+        use (see `functions_hash`), to be passed to `store_results` once the tests ran.
+        list, the names of the cached tests that lost points, for the conftest plugin to treat as failed
+        (`--failed-tests`) when the tests that depend on them run.
+    """
+    try:
+        with open(file_to_grade, "r") as file:
+            tree = ast.parse(file.read())
+    except (SyntaxError, ValueError, UnicodeDecodeError):
+        return test_names, {}, []
+    targets = graded_tests(file_with_tests, grading_spec)
+    functions = function_nodes(tree)
+    solution_names = used_solution_names(file_with_tests)
+    tests_hash = _tests_hash(file_with_tests, grading_spec)
+    to_run = []
+    misses = {}
+    failed = []
+    for test_name in targets if test_names is None else test_names:
+        graded_test = targets.get(test_name)
+        node = functions.get(graded_test.target) if graded_test else None
+        if node is None:
+            to_run.append(test_name)
+            continue
+        hash_ = functions_hash(
+            functions, graded_test.target, solution_names.get(test_name, set())
+        )
+        cached = cache.get(tests_hash, test_name, hash_)
+        progress.cache_lookup("results", cached is not None)
+        if cached is None:
+            to_run.append(test_name)
+            misses[test_name] = hash_
+            continue
+        if cached["deductions"]:
+            failed.append(test_name)
+        for deduction in cached["deductions"]:
+            if deduction["function"] is None:
+                annotate_file(
+                    file_to_grade, deduction["message"], deduction["points_to_reduce"]
+                )
+            else:
+                annotate_function(
+                    file_to_grade,
+                    deduction["function"],
+                    deduction["message"],
+                    deduction["points_to_reduce"],
+                )
+    if test_names is None and len(to_run) == len(targets):
+        # nothing was cached, let pytest collect the test file as usual
+        return None, misses, failed
+    return to_run, misses, failed
+
+
+def store_results(
+    file_with_tests: str,
+    results_file: str,
+    misses: dict,
+    cache: ResultsCache,
+    grading_spec: str = None,
+):
+    """
+    Stores the results written by the conftest plugin to `results_file` for the tests in `misses`
+    (see `apply_cached_results`). Only the tests that ran to completion are cached.
+    """
+    with open(results_file, "r") as file:
+        results = json.load(file)
+    tests_hash = _tests_hash(file_with_tests, grading_spec)
+    for test_name, hash_ in misses.items():
+        result = results.get(test_name)
+        if result is not None and result["outcome"] == "passed":
+            cache.put(tests_hash, test_name, hash_, result)
@@ -0,0 +1,41 @@
+"""
+The tests of sample_tests.py as plain pytest tests, graded with sample_grading_spec.toml.
+
+Usage:
+
+  py.test sample_tests_with_spec.py --solution sample_solution.py --grading-spec sample_grading_spec.toml
+"""
+
+import pytest
+
+
+def almost_equal(x, y, digits=6):
+    return round(x - y, digits) == 0
+
+
+@pytest.fixture
+def sample_point(solution):
+    return solution.Point(3, 4)
+
+
+def test_modulus(solution):
+    assert almost_equal(solution.modulus(3, 0), 3)
+    assert almost_equal(solution.modulus(0, 4), 4)
+    assert almost_equal(solution.modulus(3, 4), 5)
+
+
+def test_point_init(solution):
+    p = solution.Point(3, 4)
+    assert hasattr(p, "x") and almost_equal(p.x, 3)
+    assert hasattr(p, "y") and almost_equal(p.y, 4)
+
+
+def test_point_init_raise(solution):
+    with pytest.raises(ValueError):
+        solution.Point("cat", "dog")
+
+
+def test_point_str(solution, sample_point):
+    assert hasattr(solution.Point, "__str__")
+    func = getattr(solution.Point, "__str__")
+    assert func(sample_point) == "Point(+3.00, +4.00)"
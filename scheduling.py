@@ -0,0 +1,116 @@
+"""
+Order in which the submissions of a run are graded.
+
+The submissions range from short scripts to large projects, and the run is only over when its slowest file is.
+Graded in directory order, a large file that comes last keeps a single worker busy long after the others are
+done. Instead, the files are graded longest first, and urgent files (late submissions, regrade requests) go to a
+priority lane that is served before everything else.
+
+The priority lane only reorders the files of one run: a file of the lane that is not in the folders of the run is
+not graded (see `unmatched_priority`).
+
+The cost of a file is the duration of its previous grading, from the grading_record.jsonl of its folder (the
+wall-clock time of the whole `grade.grade_file` call). Files without history are estimated from their AST node
+count, scaled by the seconds per node of the files with history. The file size breaks the ties.
+"""
+import ast
+import json
+import os
+
+
+def ast_node_count(fn: str) -> int:
+    """The number of nodes of the AST of `fn`, or 0 if it does not parse (pytest rejects it quickly)."""
+    try:
+        with open(fn, "r") as file:
+            tree = ast.parse(file.read())
+    except (SyntaxError, ValueError, UnicodeDecodeError):
+        return 0
+    return sum(1 for _ in ast.walk(tree))
+
+
+def load_durations(record_file: str) -> dict:
+    """
+    Maps every file in a grading record (see `grade.grade_file`) to the duration of its last grading, in
+    seconds: the wall-clock time of the whole grading, including the start of pytest, so that all the files are
+    measured the same way.
+    """
+    ret = {}
+    if not os.path.exists(record_file):
+        return ret
+    with open(record_file, "r") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.get("duration") is not None:
+                ret[record["filename"]] = record["duration"]
+    return ret
+
+
+def estimate_costs(files: list, durations: dict = None) -> dict:
+    """
+    Estimates the time it takes to grade each of `files`.
+
+    Args:
+        files: list, the paths of the submissions.
+        durations: dict, the durations of previous gradings, by path (see `load_durations`).
+
+    Returns:
+        dict, mapping every file to its estimated cost, in seconds if there is any history, in AST nodes
+        otherwise.
+    """
+    durations = durations or {}
+    n_nodes = {fn: ast_node_count(fn) for fn in files}
+    measured = [fn for fn in files if fn in durations]
+    measured_nodes = sum(n_nodes[fn] for fn in measured)
+    seconds_per_node = 1.0
+    if measured_nodes:
+        seconds_per_node = sum(durations[fn] for fn in measured) / measured_nodes
+    return {
+        fn: durations[fn] if fn in durations else n_nodes[fn] * seconds_per_node
+        for fn in files
+    }
+
+
+def _priority_ranks(priority: list):
+    """Returns a function giving the position in `priority` of a file, matched by path or by file name, or None."""
+    rank = {}
+    for i, name in enumerate(priority or []):
+        rank.setdefault(os.path.abspath(name), i)
+        rank.setdefault(os.path.basename(name), i)
+
+    def priority_rank(fn):
+        return rank.get(os.path.abspath(fn), rank.get(os.path.basename(fn)))
+
+    return priority_rank
+
+
+def unmatched_priority(files: list, priority: list) -> list:
+    """The entries of `priority` that match none of `files`, by path or by file name (see `schedule`)."""
+    ret = []
+    for name in priority or []:
+        priority_rank = _priority_ranks([name])
+        if not any(priority_rank(fn) is not None for fn in files):
+            ret.append(name)
+    return ret
+
+
+def schedule(files: list, *, durations: dict = None, priority: list = None) -> list:
+    """
+    Returns `files` in the order to grade them: the files in `priority` first, in the given order, then the
+    others by decreasing estimated cost (longest processing time first).
+
+    Args:
+        files: list, the paths of the submissions.
+        durations: dict, the durations of previous gradings, by path (see `load_durations`).
+        priority: list, the files of the priority lane, by path or by file name. The entries that are not in
+        `files` are ignored.
+    """
+    priority_rank = _priority_ranks(priority)
+    urgent = sorted(
+        (fn for fn in files if priority_rank(fn) is not None), key=priority_rank
+    )
+    others = [fn for fn in files if priority_rank(fn) is None]
+    costs = estimate_costs(others, durations)
+    others.sort(key=lambda fn: (costs[fn], os.path.getsize(fn)), reverse=True)
+    return urgent + others
@@ -0,0 +1,357 @@
+"""
+Similarity index of the submissions in a cohort, to spot suspiciously similar (copied) code.
+
+Every submission is normalized (grader notes and docstrings stripped, identifiers renamed in order of
+appearance), split into shingles of consecutive tokens, and summarized as a MinHash signature. Locality
+sensitive hashing over bands of the signatures yields the candidate pairs, so the cost grows about linearly
+with the size of the cohort instead of comparing every pair. Signatures are cached by file content.
+
+Submissions without any code (empty, or not parsing) have no shingles: they are left out of the index and
+reported separately, instead of all looking identical.
+
+Usage:
+
+  python similarity.py -f data/submissions/group5 -t 0.8
+"""
+import ast
+import builtins
+import csv
+import hashlib
+import os
+import re
+import zlib
+
+import numpy as np
+
+from assignment_updater import strip_grader_notes
+from grade import submission_files, submission_id_from_filename
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_BUILTINS = set(dir(builtins))
+_CACHE_VERSION = 2  # bumped when the signature of the same content changes, discarding the older caches
+
+
+class _RenameIdentifiers(ast.NodeTransformer):
+    """Renames the identifiers defined by the student to v0, v1, ... in order of appearance."""
+
+    def __init__(self):
+        self.names = {}
+
+    def _rename(self, name):
+        if name in _BUILTINS:
+            return name
+        if name not in self.names:
+            self.names[name] = f"v{len(self.names)}"
+        return self.names[name]
+
+    def _strip_docstring(self, node):
+        body = node.body
+        if (
+            body
+            and isinstance(body[0], ast.Expr)
+            and isinstance(body[0].value, ast.Constant)
+            and isinstance(body[0].value.value, str)
+        ):
+            node.body = body[1:] or [ast.Pass()]
+
+    def visit_Module(self, node):
+        self._strip_docstring(node)
+        return self.generic_visit(node)
+
+    def visit_FunctionDef(self, node):
+        if not (node.name.startswith("__") and node.name.endswith("__")):
+            node.name = self._rename(node.name)
+        self._strip_docstring(node)
+        return self.generic_visit(node)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_ClassDef(self, node):
+        node.name = self._rename(node.name)
+        self._strip_docstring(node)
+        return self.generic_visit(node)
+
+    def visit_Name(self, node):
+        node.id = self._rename(node.id)
+        return node
+
+    def visit_arg(self, node):
+        node.arg = self._rename(node.arg)
+        node.annotation = None
+        return node
+
+
+def normalized_tokens(source: str) -> list:
+    """
+    Returns the tokens of `source` after stripping the grader notes, the docstrings and the comments, and
+    renaming the identifiers. Returns an empty list if `source` does not parse.
+    """
+    source = "".join(strip_grader_notes(source.splitlines(keepends=True)))
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return []
+    tree = _RenameIdentifiers().visit(tree)
+    return re.findall(r"\w+|[^\w\s]", ast.unparse(tree))
+
+
+def shingles(tokens: list, shingle_size: int) -> np.ndarray:
+    """Returns the unique 32-bit hashes of the runs of `shingle_size` consecutive tokens."""
+    if not tokens:
+        return np.empty(0, dtype=np.uint64)
+    if len(tokens) < shingle_size:
+        tokens = tokens + [""] * (shingle_size - len(tokens))
+    hashes = {
+        zlib.crc32(" ".join(tokens[i : i + shingle_size]).encode("utf-8"))
+        for i in range(len(tokens) - shingle_size + 1)
+    }
+    return np.fromiter(hashes, dtype=np.uint64, count=len(hashes))
+
+
+def _permutations(n_permutations: int, seed: int) -> (np.ndarray, np.ndarray):
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 1 << 31, size=n_permutations, dtype=np.uint64)
+    b = rng.integers(0, 1 << 31, size=n_permutations, dtype=np.uint64)
+    return a, b
+
+
+def minhash_signature(
+    shingle_hashes: np.ndarray, a: np.ndarray, b: np.ndarray
+) -> np.ndarray:
+    """
+    The MinHash signature of a set of shingles, one value per (a, b) permutation. The signature of the empty
+    set is `_MERSENNE_PRIME` everywhere, above any hash (see `has_code`).
+    """
+    if not len(shingle_hashes):
+        return np.full(len(a), _MERSENNE_PRIME, dtype=np.uint64)
+    # the hashes are below 2**32 and a, b below 2**31, so a * h + b fits in an unsigned 64-bit integer
+    values = (np.outer(a, shingle_hashes) + b[:, None]) % _MERSENNE_PRIME
+    return values.min(axis=1)
+
+
+def has_code(signature: np.ndarray) -> bool:
+    """False for the signature of a submission without any tokens, e.g. an empty file or a syntax error."""
+    return bool(signature[0] != _MERSENNE_PRIME)
+
+
+def _load_cache(cache_file: str, params: np.ndarray) -> dict:
+    if cache_file is None or not os.path.exists(cache_file):
+        return {}
+    with np.load(cache_file) as data:
+        if not np.array_equal(data["params"], params):
+            return {}
+        return dict(zip(data["keys"].tolist(), data["signatures"]))
+
+
+def _save_cache(cache_file: str, params: np.ndarray, cache: dict):
+    keys = sorted(cache)
+    tmp_file = cache_file + ".tmp.npz"
+    np.savez(
+        tmp_file,
+        params=params,
+        keys=np.array(keys),
+        signatures=np.array([cache[k] for k in keys]),
+    )
+    os.replace(tmp_file, cache_file)
+
+
+def signatures(
+    files: list,
+    *,
+    n_permutations: int = 128,
+    shingle_size: int = 5,
+    seed: int = 0,
+    cache_file: str = None,
+) -> np.ndarray:
+    """
+    Returns the MinHash signatures of `files`, one row per file.
+
+    Args:
+        files: list, the paths of the submissions.
+        n_permutations: int, the length of the signatures.
+        shingle_size: int, the number of consecutive tokens in a shingle.
+        seed: int, the seed of the random permutations.
+        cache_file: str, an .npz file in which the signatures are cached by file content across runs.
+    """
+    params = np.array([_CACHE_VERSION, n_permutations, shingle_size, seed])
+    cache = _load_cache(cache_file, params)
+    a, b = _permutations(n_permutations, seed)
+    ret = np.empty((len(files), n_permutations), dtype=np.uint64)
+    n_new = 0
+    for i, fn in enumerate(files):
+        with open(fn, "rb") as file:
+            content = file.read()
+        key = hashlib.sha1(content).hexdigest()
+        if key not in cache:
+            tokens = normalized_tokens(content.decode("utf-8", errors="replace"))
+            cache[key] = minhash_signature(shingles(tokens, shingle_size), a, b)
+            n_new += 1
+        ret[i] = cache[key]
+    if cache_file is not None and n_new:
+        _save_cache(cache_file, params, cache)
+    return ret
+
+
+def candidate_pairs(signatures_: np.ndarray, n_bands: int) -> set:
+    """Pairs of rows whose signatures are identical in at least one band (locality sensitive hashing)."""
+    n_rows = signatures_.shape[1] // n_bands
+    pairs = set()
+    for band in range(n_bands):
+        band_values = signatures_[:, band * n_rows : (band + 1) * n_rows]
+        # group the identical bands together
+        _, bucket_ids = np.unique(band_values, axis=0, return_inverse=True)
+        bucket_ids = bucket_ids.ravel()
+        order = np.argsort(bucket_ids, kind="stable")
+        boundaries = np.flatnonzero(np.diff(bucket_ids[order])) + 1
+        for bucket in np.split(order, boundaries):
+            if len(bucket) < 2:
+                continue
+            for i, first in enumerate(bucket):
+                for second in bucket[i + 1 :]:
+                    pairs.add((int(first), int(second)))
+    return pairs
+
+
+def similarity_clusters(
+    files: list,
+    *,
+    threshold: float = 0.8,
+    n_permutations: int = 128,
+    n_bands: int = 32,
+    shingle_size: int = 5,
+    cache_file: str = None,
+    signatures_: np.ndarray = None,
+) -> list:
+    """
+    Groups the files whose estimated similarity (Jaccard similarity of the shingles) is at least `threshold`.
+    The files without any code (see `has_code`) are in no cluster.
+
+    Args:
+        signatures_: np.ndarray, the signatures of `files`, if they were already computed (see `signatures`).
+
+    Returns:
+        list, the clusters, each a list of (file, highest similarity to another member of the cluster) tuples,
+        largest cluster first.
+    """
+    if signatures_ is None:
+        signatures_ = signatures(
+            files,
+            n_permutations=n_permutations,
+            shingle_size=shingle_size,
+            cache_file=cache_file,
+        )
+    indexed = [i for i, signature in enumerate(signatures_) if has_code(signature)]
+    files = [files[i] for i in indexed]
+    signatures_ = signatures_[indexed]
+    # identical signatures (e.g. verbatim copies) are compared once
+    unique_signatures, inverse = np.unique(signatures_, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    parent = list(range(len(unique_signatures)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    best = np.zeros(len(unique_signatures))
+    counts = np.bincount(inverse, minlength=len(unique_signatures))
+    best[counts > 1] = 1.0
+    for first, second in candidate_pairs(unique_signatures, n_bands):
+        similarity = np.mean(unique_signatures[first] == unique_signatures[second])
+        if similarity < threshold:
+            continue
+        best[first] = max(best[first], similarity)
+        best[second] = max(best[second], similarity)
+        parent[find(first)] = find(second)
+
+    clusters = {}
+    for i, unique_i in enumerate(inverse):
+        if best[unique_i]:
+            clusters.setdefault(find(unique_i), []).append(
+                (files[i], float(best[unique_i]))
+            )
+    return sorted(clusters.values(), key=len, reverse=True)
+
+
+def find_similar_submissions(
+    *,
+    folder: str,
+    threshold: float = 0.8,
+    n_permutations: int = 128,
+    n_bands: int = 32,
+    shingle_size: int = 5,
+    output_file: str = None,
+    use_cache: bool = True,
+):
+    """
+    Reports the clusters of similar submissions in a folder.
+
+    Args:
+        folder: str, the folder with the submissions. Several folders can be given, separated by commas, and are
+        indexed together.
+        threshold: float, the minimal estimated similarity (between 0 and 1) of two submissions in a cluster.
+        n_permutations: int, the length of the MinHash signatures.
+        n_bands: int, the number of LSH bands. More bands find pairs with a lower similarity, at a higher cost.
+        shingle_size: int, the number of consecutive tokens in a shingle.
+        output_file: str, a csv file to write the clusters to. Defaults to similarity.csv in the (first) folder.
+        use_cache: bool, if True, cache the signatures in similarity_cache.npz in the (first) folder.
+    """
+    folders = folder.split(",")
+    files = [f for folder_ in folders for f in submission_files(folder_)]
+    cache_file = os.path.join(folders[0], "similarity_cache.npz") if use_cache else None
+    signatures_ = signatures(
+        files,
+        n_permutations=n_permutations,
+        shingle_size=shingle_size,
+        cache_file=cache_file,
+    )
+    clusters = similarity_clusters(
+        files,
+        threshold=threshold,
+        n_permutations=n_permutations,
+        n_bands=n_bands,
+        shingle_size=shingle_size,
+        signatures_=signatures_,
+    )
+    if output_file is None:
+        output_file = os.path.join(folders[0], "similarity.csv")
+    with open(output_file, "w") as file:
+        writer = csv.DictWriter(
+            file, fieldnames=["cluster", "filename", "submission_id", "similarity"]
+        )
+        writer.writeheader()
+        for i, cluster in enumerate(clusters):
+            print(f"Cluster {i}:")
+            for fn, similarity in cluster:
+                print(f"    {os.path.basename(fn):<40s} {similarity:.2f}")
+                writer.writerow(
+                    {
+                        "cluster": i,
+                        "filename": os.path.basename(fn),
+                        "submission_id": submission_id_from_filename(fn),
+                        "similarity": round(similarity, 3),
+                    }
+                )
+    without_code = [fn for fn, sig in zip(files, signatures_) if not has_code(sig)]
+    if without_code:
+        print("Not indexed, no code (empty or not parsing):")
+        for fn in without_code:
+            print(f"    {os.path.basename(fn)}")
+    print(
+        f"{len(clusters)} clusters among {len(files) - len(without_code)} submissions"
+    )
+    return clusters
+
+
+if __name__ == "__main__":
+    import defopt
+
+    defopt.run(
+        find_similar_submissions,
+        short={
+            "folder": "f",
+            "threshold": "t",
+            "output-file": "o",
+        },
+    )
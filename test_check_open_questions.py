@@ -0,0 +1,116 @@
+"""
+Checks of the batched grading of open questions, against the deterministic StubBackend.
+
+Usage:
+
+  py.test test_check_open_questions.py
+"""
+import json
+
+from check_open_questions import grade_student_responses, is_valid_grading_response
+from grading_backends import StubBackend
+
+
+class MissingVerdictBackend(StubBackend):
+    """Answers batched requests without the verdict of the response with id `missing_id`."""
+
+    def __init__(self, missing_id: int):
+        super().__init__()
+        self.missing_id = missing_id
+        self.n_single_calls = 0
+
+    def complete(self, system_message: str) -> str:
+        resp = super().complete(system_message)
+        data = json.loads(resp)
+        if "verdicts" not in data:
+            self.n_single_calls += 1
+            return resp
+        data["verdicts"] = [v for v in data["verdicts"] if v["id"] != self.missing_id]
+        return json.dumps(data)
+
+
+class FailingSingleCallsBackend(StubBackend):
+    """Answers batched requests with garbage, and fails the first `n_failures` single-response requests."""
+
+    def __init__(self, n_failures: int):
+        super().__init__()
+        self.n_failures = n_failures
+        self.n_requests = 0
+
+    def complete(self, system_message: str) -> str:
+        self.n_requests += 1
+        if '<response id="' in system_message:
+            return "not json"
+        if self.n_failures:
+            self.n_failures -= 1
+            raise RuntimeError("connection reset")
+        return super().complete(system_message)
+
+
+def test_batches_are_graded_in_one_call():
+    backend = StubBackend()
+    grades = grade_student_responses(
+        "q",
+        "a",
+        ["r1", "r2", "", "r4", "r5"],
+        batch_size=2,
+        n_grades=1,
+        quiet=True,
+        backend=backend,
+    )
+    assert backend.n_calls == 3
+    assert [g["grade"] for g in grades] == [100, 100, 0, 100, 100]
+
+
+def test_missing_verdict_falls_back_to_a_single_call():
+    backend = MissingVerdictBackend(missing_id=2)
+    grades = grade_student_responses(
+        "q",
+        "a",
+        ["r1", "r2", "r3"],
+        batch_size=3,
+        n_grades=1,
+        quiet=True,
+        backend=backend,
+    )
+    assert backend.n_single_calls == 1
+    assert [g["grade"] for g in grades] == [100, 100, 100]
+
+
+def test_failing_fallback_is_retried_per_response():
+    backend = FailingSingleCallsBackend(n_failures=2)
+    grades = grade_student_responses(
+        "q",
+        "a",
+        ["r1", "r2"],
+        batch_size=2,
+        n_grades=1,
+        n_retries_on_error=3,
+        quiet=True,
+        backend=backend,
+    )
+    # one batched call, two failed and two successful single calls; the batch is not re-sent
+    assert backend.n_requests == 5
+    assert [g["grade"] for g in grades] == [100, 100]
+
+
+def test_ungraded_response_does_not_discard_the_others():
+    backend = FailingSingleCallsBackend(n_failures=3)
+    grades = grade_student_responses(
+        "q",
+        "a",
+        ["r1", "r2"],
+        batch_size=2,
+        n_grades=1,
+        n_retries_on_error=3,
+        quiet=True,
+        backend=backend,
+    )
+    assert grades[0] is None
+    assert grades[1]["grade"] == 100
+
+
+def test_empty_verdict_is_valid():
+    assert is_valid_grading_response({"valid": "empty"})
+    assert not is_valid_grading_response({"valid": "valid"})
+    assert is_valid_grading_response(StubBackend.perfect_verdict)